@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Compare single and double precision transforms of sound samples
+"""
+import glob
+import logging
+import os
+import time
+
+import click
+import numpy as np
+
+from analyze.composition import Composition
+from analyze.media.sound import SoundFromSoundFile
+
+
+logging.basicConfig()
+
+log = logging.getLogger(__name__)
+
+
+def transform(sound, precision, backend, scale_resolution):
+    with Composition(sound, scale_resolution=scale_resolution,
+                     backend=backend, precision=precision) as composition:
+        start = time.perf_counter()
+        complex_image = composition.get_complex_image()
+
+        return complex_image, time.perf_counter() - start
+
+
+@click.command()
+@click.argument('sound_files', nargs=-1, type=click.Path(exists=True))
+@click.option('--backend', default='numpy')
+@click.option('--scale_resolution', type=float, default=1/36)
+@click.option('--verbose/--silent', default=False)
+def main(sound_files, backend, scale_resolution, verbose):
+    if verbose:
+        logging.getLogger('').setLevel(logging.DEBUG)
+
+    if not sound_files:
+        samples_dir = os.path.join(os.path.dirname(__file__), 'sound_samples')
+        sound_files = sorted(glob.glob(os.path.join(samples_dir, '*.wav')))
+
+    template = '{:<20} {:>12} {:>12} {:>10} {:>10}'
+
+    click.echo(template.format('sound', 'max error', 'rms error',
+                               'single, s', 'double, s'))
+
+    for sound_file in sound_files:
+        sound = SoundFromSoundFile(sound_file)
+
+        single, single_time = transform(sound, 'single', backend,
+                                        scale_resolution)
+        double, double_time = transform(sound, 'double', backend,
+                                        scale_resolution)
+
+        # Ошибки относительно максимума и энергии точного результата
+        error = np.abs(single - double)
+        peak = np.abs(double).max() or 1
+        energy = np.sqrt(np.mean(np.abs(double) ** 2)) or 1
+
+        click.echo(template.format(
+            os.path.basename(sound_file),
+            '{:.2e}'.format(error.max() / peak),
+            '{:.2e}'.format(np.sqrt(np.mean(error ** 2)) / energy),
+            '{:.2f}'.format(single_time),
+            '{:.2f}'.format(double_time),
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+On disk cache of numpy arrays shared between processes
+
+Every entry is a directory of .npy files which are loaded memory mapped,
+so processes reading the same entry share its pages. Entries are written
+to a temporary directory and renamed into place, so readers never see
+a half written entry. When the cache grows above its size limit the least
+recently used entries are removed.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+log = logging.getLogger(__name__)
+
+
+CACHE_DIR = os.environ.get(
+    'WAVELET_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache',
+                 'wavelet_sound_microscope')
+)
+
+
+def test_disk_cache_evicts_least_recently_used():
+    with tempfile.TemporaryDirectory() as root:
+        cache = DiskCache('test', size_limit=2000, root=root)
+
+        cache.store('a', {'x': np.zeros(100)})
+        os.utime(cache.path('a'), (0, 0))
+        cache.store('b', {'x': np.ones(100)})
+        os.utime(cache.path('b'), (1, 1))
+
+        assert cache.load('a')['x'].sum() == 0
+        cache.store('c', {'x': np.ones(100)})
+
+        assert cache.load('a') is not None
+        assert cache.load('b') is None
+        assert cache.cached('c', None)['x'].sum() == 100
+
+        cache.store('d', {'x': np.ones(1000)})
+        assert not os.path.exists(cache.path('d'))
+
+
+def test_disk_cache_failure_returns_arrays():
+    with tempfile.TemporaryDirectory() as root:
+        # Каталог кеша нельзя создать внутри файла
+        not_directory = os.path.join(root, 'file')
+        open(not_directory, 'w').close()
+
+        cache = DiskCache('test', size_limit=2000, root=not_directory)
+        arrays = cache.cached('a', lambda: {'x': np.ones(10)})
+
+        assert arrays['x'].sum() == 10
+        assert cache.load('a') is None
+
+
+class DiskCache(object):
+    def __init__(self, name, size_limit, root=CACHE_DIR):
+        self.directory = os.path.join(root, name)
+        self.size_limit = size_limit
+
+    def path(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+        return os.path.join(self.directory, digest)
+
+    def load(self, key):
+        """ Dict of read only memory mapped arrays or None """
+
+        path = self.path(key)
+
+        try:
+            names = os.listdir(path)
+
+            # Время изменения каталога служит временем последнего доступа
+            os.utime(path)
+
+            return {
+                os.path.splitext(name)[0]: np.load(os.path.join(path, name),
+                                                   mmap_mode='r')
+                for name in names
+            }
+
+        except OSError:
+            # Нет записи или ее только что вытеснил другой процесс
+            return None
+
+    def store(self, key, arrays):
+        """ Stored arrays, given ones when the cache can not keep them """
+
+        if sum(array.nbytes for array in arrays.values()) > self.size_limit:
+            # Запись больше всего кеша все равно сразу вытеснится
+            return arrays
+
+        try:
+            self._write(key, arrays)
+            self.evict()
+
+        except OSError as e:
+            # Без кеша только медленнее, вычисленное не теряем
+            log.warning('Can not store to cache %s: %s', self.directory, e)
+
+            return arrays
+
+        stored = self.load(key)
+
+        return arrays if stored is None else stored
+
+    def _write(self, key, arrays):
+        os.makedirs(self.directory, exist_ok=True)
+
+        tmp_path = tempfile.mkdtemp(dir=self.directory, prefix='.')
+
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_path, name + '.npy'), array)
+
+            os.rename(tmp_path, self.path(key))
+
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+            # Другой процесс записал ту же запись раньше
+            if not os.path.isdir(self.path(key)):
+                raise
+
+    def evict(self):
+        entries = []
+
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+
+            path = os.path.join(self.directory, name)
+
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                entries.append((os.stat(path).st_mtime, size, path))
+
+            except OSError:
+                continue
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total <= self.size_limit:
+                break
+
+            log.debug('Evict %s from cache', path)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def cached(self, key, compute):
+        """ Load arrays by key or compute, store and load them """
+
+        arrays = self.load(key)
+
+        if arrays is None:
+            arrays = self.store(key, compute())
+
+        return arrays
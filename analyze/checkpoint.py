@@ -0,0 +1,136 @@
+"""
+Checkpoints of interrupted transforms
+
+A checkpoint is a directory with final columns of every transformed piece
+and the overlap state after the last of them. Each chunk is written
+before the state which counts it, both are renamed into place, so after
+a crash or cancel the state always describes chunks on disk and a rerun
+continues from the first missing piece.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from .cache import CACHE_DIR
+
+
+log = logging.getLogger(__name__)
+
+
+CHECKPOINTS_DIR = os.path.join(CACHE_DIR, 'checkpoints')
+
+# Незавершенные запуски старше недели удаляются
+CHECKPOINT_MAX_AGE = 7 * 24 * 60 * 60
+
+
+def test_checkpoint_restores_overlap_state():
+    from .wavelet.base import OverlapAdd
+
+    with tempfile.TemporaryDirectory() as root:
+        checkpoint = Checkpoint('key', root=root)
+        overlap_add = OverlapAdd(2, 1)
+
+        for index in range(3):
+            image = np.full((2, 4), index, np.complex64)
+            checkpoint.save(index, overlap_add.add(image), overlap_add)
+
+        restored = OverlapAdd(2, 1)
+        checkpoint = Checkpoint('key', root=root)
+
+        assert checkpoint.restore(restored) == 3
+        assert restored.column == overlap_add.column
+        assert np.array_equal(restored.tail, overlap_add.tail)
+        assert [chunk.shape[1] for chunk in checkpoint.chunks()] == [1, 2, 2]
+
+        checkpoint.clear()
+        assert Checkpoint('key', root=root).restore(OverlapAdd(2, 1)) == 0
+
+
+class Checkpoint(object):
+    def __init__(self, key, root=CHECKPOINTS_DIR):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+        self.directory = os.path.join(root, digest)
+        self.done = 0
+
+        remove_stale(root)
+
+    def restore(self, overlap_add):
+        """ Set overlap state of saved pieces, return their count """
+
+        try:
+            state = np.load(self._path('state.npz'))
+
+        except OSError:
+            return 0
+
+        overlap_add.tail = state['tail']
+        overlap_add.column = int(state['column'])
+        self.done = int(state['done'])
+
+        log.debug('Resume %s from piece %d', self.directory, self.done)
+
+        return self.done
+
+    def chunks(self):
+        """ Final columns of saved pieces in order """
+
+        for index in range(self.done):
+            yield np.load(self._chunk_path(index), mmap_mode='r')
+
+    def save(self, index, chunk, overlap_add):
+        """ Save final columns of piece index and overlap state after it """
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._write(self._chunk_path(index), np.save, chunk)
+        self._write(self._path('state.npz'), np.savez,
+                    tail=overlap_add.tail, column=overlap_add.column,
+                    done=index + 1)
+
+        self.done = index + 1
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.done = 0
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _chunk_path(self, index):
+        return self._path('chunk_{:08d}.npy'.format(index))
+
+    def _write(self, path, save, *args, **kwargs):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.')
+
+        with os.fdopen(fd, 'wb') as f:
+            save(f, *args, **kwargs)
+
+        os.replace(tmp_path, path)
+
+
+def remove_stale(root, max_age=CHECKPOINT_MAX_AGE):
+    try:
+        names = os.listdir(root)
+
+    except OSError:
+        return
+
+    deadline = time.time() - max_age
+
+    for name in names:
+        path = os.path.join(root, name)
+
+        try:
+            if os.stat(path).st_mtime < deadline:
+                log.debug('Remove stale checkpoint %s', path)
+                shutil.rmtree(path, ignore_errors=True)
+
+        except OSError:
+            continue
@@ -1,78 +1,494 @@
+from collections import deque
 import bisect
 import logging
+import time
 
 import numpy as np
-from scipy.misc import toimage
+from PIL import Image
 
+from .cache import DiskCache
+from .checkpoint import Checkpoint
 from .media import apply_colormap
+from .media.sound import LiveSound, StoredSound, samples_digest
+from .spectrogram_file import SpectrogramReader, SpectrogramWriter
+from .wavelet.base import CWT_VERSION, OverlapAdd, SpectraCache, \
+    check_output, frequency_rows, reduce_columns, smallest_block_size
+from .wavelet.pool import WAVELET_BOXES
 from utils import cached_property, ProgressProxy
 
 
 log = logging.getLogger(__name__)
 
 
+# Изображения по хешу звука и всем параметрам преобразования
+RESULTS_CACHE = DiskCache('compositions', size_limit=4 * 2 ** 30)
+
+# Грубые проходы: (scale_resolution, во сколько раз сильнее прореживание)
+PROGRESSIVE_PASSES = ((1/8, 16), (1/32, 4))
+
+# Спектры кусков сверх этого считаются заново каждым проходом
+PROGRESSIVE_SPECTRA_LIMIT = 256 * 2 ** 20
+
+
 class Composition(object):
     def __init__(self, sound,
-                 scale_resolution=1/36, omega0=70):
+                 scale_resolution=1/36, omega0=70,
+                 backend='numpy', threads=None, backend_options=None,
+                 block_size=2 ** 17, overlap=1/2, window='hann',
+                 lowest_frequency=None, precision='single', cache=False,
+                 resumable=False):
+        """
+        backend is a name from analyze.wavelet.registry or 'auto' for the
+        fastest one on this machine. threads limits parallel backends,
+        all cores by default. backend_options are passed to the box.
+
+        Sound is transformed by windowed blocks of block_size samples
+        overlapped by overlap ratio (rounded to whole decimated columns),
+        window is a scipy.signal.get_window name. lowest_frequency
+        replaces block_size with the smallest block reaching it, smaller
+        blocks have lower latency.
+
+        precision is 'single' (float32 and complex64 all the way to the
+        spectrogram) or 'double'.
+
+        With cache images are kept on disk by hash of the samples and
+        parameters and returned read only memory mapped, even when just
+        computed.
+
+        With resumable every transformed block is saved to a checkpoint,
+        so a rerun with the same parameters after a cancel or crash goes
+        on from the first missing block.
+        """
         self.sound = sound
         self.scale_resolution = scale_resolution
         self.omega0 = omega0
+        self.backend = backend
+        self.threads = threads
+        self.backend_options = backend_options or {}
 
         # samplerate = sound.samples / sound.duration
         self.samplerate = sound.samplerate
 
-        self.block_size = 2 ** 17
+        if lowest_frequency is not None:
+            block_size = smallest_block_size(lowest_frequency,
+                                             self.samplerate,
+                                             scale_resolution, omega0)
+
+        self.block_size = block_size
+        self.overlap = overlap
+        self.window = window
+        self.precision = precision
+        self.cache = cache
+        self.resumable = resumable
         self.decimate = 2 ** int(np.log2(self.samplerate) - 8)
 
         self._wbox = None
 
     def __enter__(self):
-        from .wavelet.intel_backend import WaveletBox
-
-        self._wbox = WaveletBox(
+        self._wbox = WAVELET_BOXES.acquire(
+            self.backend,
             self.block_size,
             samplerate=self.samplerate,
             scale_resolution=self.scale_resolution,
-            omega0=self.omega0
+            omega0=self.omega0,
+            workers=self.threads,
+            decimate=self.decimate,
+            precision=self.precision,
+            **self.backend_options
         )
 
         return self
 
     def __exit__(self, exc_type, exc_value, tb):
-        # FIXME cache wbox or free resources
+        WAVELET_BOXES.release(self._wbox)
         self._wbox = None
 
-    def get_complex_image(self, progressbar=None):
-        if not self._wbox:
-            raise RuntimeError('You need to use {} in a with block'.
-                               format(self.__class__.__name__))
+    def get_complex_image(self, progressbar=None, time_range=None,
+                          freq_range=None):
+        return self.get_image('complex', progressbar, time_range, freq_range)
+
+    def get_image(self, output='complex', progressbar=None, time_range=None,
+                  freq_range=None):
+        """
+        output is 'complex', 'magnitude', 'power' or 'db'
+
+        Real outputs are reduced column by column as soon as overlapped
+        blocks are summed, so the complex image is never allocated.
+
+        time_range (begin, end) seconds and freq_range (lower, upper) Hz
+        limit the image as Spectrogram.get_region does, only blocks
+        covering the range and scales within the band are transformed.
+        """
+        self._check_entered()
 
         if not progressbar:
             progressbar = ProgressProxy
 
-        return self._wbox.sound_apply_cwt(
-            self.sound, progressbar, decimate=self.decimate
+        if time_range is not None or freq_range is not None:
+            return self._get_region(output, progressbar, time_range,
+                                    freq_range)
+
+        return self._get_whole_image(output, progressbar)
+
+    def _get_whole_image(self, output, progressbar, spectra=None):
+        def compute():
+            checkpoint = None
+
+            if self.resumable:
+                checkpoint = Checkpoint(self._cache_key(output))
+
+            image = self._wbox.sound_apply_cwt(
+                self.sound, progressbar, output=output,
+                checkpoint=checkpoint, spectra=spectra, **self._cwt_options
+            )
+
+            if checkpoint is not None:
+                checkpoint.clear()
+
+            return {'image': image}
+
+        if not self.cache:
+            return compute()['image']
+
+        return RESULTS_CACHE.cached(self._cache_key(output), compute)['image']
+
+    def save(self, path, output='magnitude', progressbar=None,
+             **writer_options):
+        """
+        Write image to a chunked spectrogram file column by column
+
+        writer_options are chunk_shape and compression of
+        SpectrogramWriter, the image is never kept whole.
+        """
+        self._check_entered()
+
+        with SpectrogramWriter(
+            path,
+            height=len(self._wbox.scales),
+            dtype=(self._wbox.complex_dtype if output == 'complex'
+                   else self._wbox.real_dtype),
+            frequencies=self._wbox.frequencies,
+            samplerate=self.samplerate,
+            decimate=self.decimate,
+            sound_size=self.sound.size,
+            **writer_options
+        ) as writer:
+            for columns in self.iter_image(output, progressbar):
+                writer.write(columns)
+
+    def _get_region(self, output, progressbar, time_range, freq_range):
+        begin, end = sorted(time_range or (0, self.sound.duration))
+
+        return self._wbox.sound_apply_region_cwt(
+            self.sound, progressbar,
+            start=self.sound.time2x(begin),
+            stop=self.sound.time2x(end),
+            rows=frequency_rows(self._wbox.frequencies,
+                                *(freq_range or (None, None))),
+            output=output, **self._cwt_options
         )
 
-    def get_spectrogram(self, progressbar=None):
-        complex_image = self.get_complex_image(progressbar)
+    @cached_property
+    def _samples_digest(self):
+        return samples_digest(self.sound)
+
+    def _cache_key(self, output):
+        return (
+            'composition', CWT_VERSION, self._samples_digest, self.sound.size,
+            self.backend, tuple(sorted(self.backend_options.items())),
+            float(self.scale_resolution), float(self.omega0),
+            self.block_size, float(self.overlap), self.window,
+            self.precision, self.decimate, output,
+        )
+
+    def iter_complex_image(self, progressbar=None):
+        return self.iter_image('complex', progressbar)
+
+    def iter_abs_image(self, progressbar=None):
+        return self.iter_image('magnitude', progressbar)
+
+    def iter_image(self, output='complex', progressbar=None):
+        """
+        Yield image by column chunks as soon as they are ready
+
+        Memory use is about two blocks whatever the sound length is.
+        """
+        self._check_entered()
+
+        if not progressbar:
+            progressbar = ProgressProxy
+
+        return self._wbox.sound_iter_cwt(
+            self.sound, progressbar, output=output, **self._cwt_options
+        )
+
+    @property
+    def _cwt_options(self):
+        return dict(decimate=self.decimate, overlap=self.overlap,
+                    window=self.window)
 
+    def _check_entered(self):
+        if not self._wbox:
+            raise RuntimeError('You need to use {} in a with block'.
+                               format(self.__class__.__name__))
+
+    def get_spectrogram(self, progressbar=None):
         return Spectrogram(
-            abs_image=np.abs(complex_image),
+            abs_image=self.get_image('magnitude', progressbar),
             sound=self.sound,
             frequencies=self._wbox.frequencies
         )
 
+    def iter_progressive_image(self, output='magnitude', progressbar=None,
+                               passes=PROGRESSIVE_PASSES):
+        """
+        Yield a new image after every pass, coarse passes first
+
+        Passes of passes coarser than scale_resolution have fewer scales
+        and columns, so the first is ready in a small part of the full
+        time, its image is stretched to the final size. Spectra of
+        windowed blocks are kept up to PROGRESSIVE_SPECTRA_LIMIT for the
+        next passes, which only multiply and invert them. The last image
+        is get_image(output), resumable as well.
+        """
+        self._check_entered()
+        check_output(output)
+
+        if not progressbar:
+            progressbar = ProgressProxy
+
+        if self.cache:
+            cached = RESULTS_CACHE.load(self._cache_key(output))
+
+            if cached is not None:
+                yield cached['image']
+                return
+
+        spectra = SpectraCache(PROGRESSIVE_SPECTRA_LIMIT)
+
+        for scale_resolution, factor in passes:
+            if scale_resolution <= self.scale_resolution:
+                continue
+
+            wbox = WAVELET_BOXES.acquire(
+                self.backend,
+                self.block_size,
+                samplerate=self.samplerate,
+                scale_resolution=scale_resolution,
+                omega0=self.omega0,
+                workers=self.threads,
+                decimate=self.decimate,
+                precision=self.precision,
+                **self.backend_options
+            )
+
+            try:
+                coarse = wbox.sound_apply_cwt(
+                    self.sound, progressbar, output=output,
+                    decimate=self._coarse_decimate(factor),
+                    overlap=self.overlap, window=self.window,
+                    spectra=spectra
+                )
+                frequencies = wbox.frequencies
+
+            finally:
+                WAVELET_BOXES.release(wbox)
+
+            # Каждый проход - новый массив, прошлый еще может рисоваться
+            image = np.empty(
+                (len(self._wbox.scales), self.sound.size // self.decimate),
+                coarse.dtype
+            )
+            stretch(coarse, frequencies, image, self._wbox.frequencies)
+
+            yield image
+
+        yield self._get_whole_image(output, progressbar, spectra)
+
+    def iter_progressive_spectrograms(self, progressbar=None,
+                                      passes=PROGRESSIVE_PASSES):
+        for abs_image in self.iter_progressive_image('magnitude',
+                                                     progressbar, passes):
+            yield Spectrogram(
+                abs_image=abs_image,
+                sound=self.sound,
+                frequencies=self._wbox.frequencies
+            )
+
+    def _coarse_decimate(self, factor):
+        """ decimate times factor, reduced until pieces stay the same """
+
+        layout = self._wbox.block_layout(self.overlap, self.window,
+                                         self.decimate)
+        decimate = self.decimate * factor
+
+        # Спектры общие для проходов, только пока куски те же
+        while layout.hop % decimate or layout.lead % decimate or \
+                self._wbox.block_layout(self.overlap, self.window,
+                                        decimate).lead != layout.lead:
+            decimate //= 2
+
+        return decimate
+
+
+def test_stretch():
+    image = np.array([[1, 2], [3, 4]])
+    out = np.zeros((3, 4), dtype=int)
+
+    stretch(image, np.array([400, 100]), out, np.array([500, 150, 90]))
+
+    assert out.tolist() == [[1, 1, 2, 2], [3, 3, 4, 4], [3, 3, 4, 4]]
+
+
+def stretch(image, frequencies, out, out_frequencies):
+    """ Nearest pixels of image over out, rows by log frequency """
+
+    if not image.size:
+        return
+
+    rows = np.interp(np.log(out_frequencies), np.log(frequencies[::-1]),
+                     np.arange(len(frequencies))[::-1])
+    columns = np.arange(out.shape[1]) * image.shape[1] // out.shape[1]
+
+    np.take(np.take(image, np.rint(rows).astype(int), axis=0), columns,
+            axis=1, out=out)
+
+
+class LiveComposition(Composition):
+    """
+    Spectrogram of a live feed pushed by chunks of any size
+
+    Every hop of pushed samples completes a windowed block in the ring
+    buffer, its image is overlap added and columns which became final are
+    returned by push, reduced to output as in Composition.get_image.
+    """
+
+    def __init__(self, samplerate, output='magnitude', **kwargs):
+        super(LiveComposition, self).__init__(LiveSound(samplerate),
+                                              **kwargs)
+
+        check_output(output)
+        self.output = output
+
+        self.processing_times = deque(maxlen=100)
+
+    def __enter__(self):
+        super(LiveComposition, self).__enter__()
+
+        self._block_layout = self._wbox.block_layout(
+            self.overlap, self.window, self.decimate
+        )
+        self._overlap_add = OverlapAdd(
+            self._block_layout.hop // self.decimate,
+            self._block_layout.lead // self.decimate
+        )
+
+        # Начальные нули служат ведущим дополнением первого блока
+        self._ring = np.zeros(self.block_size, self._wbox.real_dtype)
+        self._position = 0  # Куда писать, там же самый старый отсчет
+        self._pending = 0  # Отсчетов после последнего блока
+
+        return self
+
+    @property
+    def latency(self):
+        """ Longest delay of a pushed sample until its column, seconds """
+
+        return self.block_size / self.samplerate
+
+    @property
+    def processing_time(self):
+        """ Mean processing time of recently pushed chunks, seconds """
+
+        if not self.processing_times:
+            return 0
+
+        return sum(self.processing_times) / len(self.processing_times)
+
+    def push(self, samples):
+        """ Add samples, return image columns which became final """
+
+        self._check_entered()
+
+        started = time.perf_counter()
+
+        samples = np.asarray(samples)
+        self.sound.extend(len(samples))
+
+        hop = self._block_layout.hop
+        chunks = []
+
+        while len(samples):
+            count = min(len(samples), hop - self._pending,
+                        self.block_size - self._position)
+
+            self._ring[self._position:self._position + count] = \
+                samples[:count]
+            samples = samples[count:]
+
+            self._position = (self._position + count) % self.block_size
+            self._pending += count
+
+            if self._pending == hop:
+                self._pending = 0
+
+                piece = np.roll(self._ring, -self._position)
+                piece *= self._block_layout.window
+
+                image = self._wbox.cwt(piece, self.decimate)
+                chunks.append(self._reduce(self._overlap_add.add(image)))
+
+        if chunks:
+            columns = np.concatenate(chunks, axis=1)
+
+        else:
+            columns = self._reduce(
+                np.zeros((len(self._wbox.scales), 0),
+                         self._wbox.complex_dtype)
+            )
+
+        self.processing_times.append(time.perf_counter() - started)
+
+        return columns
+
+    def _reduce(self, chunk):
+        if self.output == 'complex':
+            return chunk
+
+        return reduce_columns(chunk, self.output,
+                              np.empty(chunk.shape, self._wbox.real_dtype))
+
 
 class Spectrogram(object):
     def __init__(self, abs_image, sound, frequencies):
         self.abs_image = abs_image
-        self.image = toimage(apply_colormap(self.abs_image))
-        self.width, self.height = self.image.size
+        self.height, self.width = self.abs_image.shape
         self.sound = sound
         self.frequencies = frequencies
         self.reversed_frequencies = list(reversed(frequencies))
 
+    @cached_property
+    def rgb_image(self):
+        return apply_colormap(self.abs_image)
+
+    @cached_property
+    def image(self):
+        return Image.fromarray(self.rgb_image, 'RGB')
+
+    def get_region(self, time_range=None, freq_range=None):
+        """ Part of abs_image for (begin, end) seconds, (lower, upper) Hz """
+
+        x1, x2 = map(self.time2x, time_range or (0, self.sound.duration))
+
+        if freq_range:
+            lower, upper = freq_range
+            y1, y2 = self.freq2y(upper), self.freq2y(lower)
+
+        else:
+            y1, y2 = 0, self.height
+
+        return self.abs_image[y1:y2, x1:x2]
+
     def x2time(self, x):
         """
         Assume self.width and self.sound.size equal
@@ -100,3 +516,19 @@ class Spectrogram(object):
         frequency_band = tuple(map(self.y2freq, y1y2))
 
         return self.sound.get_fragment(time_band, frequency_band)
+
+
+def load_spectrogram(path):
+    """
+    Spectrogram of a file saved by Composition.save
+
+    Its abs_image reads tiles from disk on slicing, so ranges of hour long
+    recordings are available without loading them whole.
+    """
+    reader = SpectrogramReader(path)
+
+    return Spectrogram(
+        abs_image=reader,
+        sound=StoredSound(reader.sound_size, reader.samplerate),
+        frequencies=reader.frequencies
+    )
@@ -1,3 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+
 import numpy as np
 from matplotlib.colors import LinearSegmentedColormap
 
@@ -15,11 +18,96 @@ lightfire_colormap = LinearSegmentedColormap.from_list(
 )
 
 
-def apply_colormap(image, cmap=None):
+# Пикселей на один поток при раскраске
+COLORMAP_CHUNK_SIZE = 2 ** 20
+
+# Столбцов изображения с диска, читаемых за раз (четное, для 2 x 2)
+COLUMN_STRIP_WIDTH = 4096
+
+_colormap_luts = {}
+
+
+def colormap_lut(cmap=None, size=256):
+    """ RGB uint8 table of size colors sampled evenly from cmap """
+
     if not cmap:
         cmap = lightfire_colormap
 
-    return 255 * cmap(image)[:, :, :3]
+    key = (cmap.name, size)
+
+    if key not in _colormap_luts:
+        colors = cmap.resampled(size)(np.arange(size), bytes=True)
+        _colormap_luts[key] = np.ascontiguousarray(colors[:, :3])
+
+    return _colormap_luts[key]
+
+
+def test_apply_colormap_matches_matplotlib():
+    image = np.random.RandomState(0).uniform(-0.1, 1.1, (7, 100))
+    image = image.astype(np.float32)
+
+    expected = lightfire_colormap(image, bytes=True)[:, :, :3]
+
+    assert np.array_equal(apply_colormap(image, threads=3), expected)
+    assert apply_colormap(image, lut_size=4096).dtype == np.uint8
+
+
+def column_strips(width, strip_width=COLUMN_STRIP_WIDTH):
+    return [
+        slice(start, min(start + strip_width, width))
+        for start in range(0, width, strip_width)
+    ]
+
+
+def apply_colormap(image, cmap=None, lut_size=256, threads=None):
+    """
+    RGB uint8 image of values in [0, 1] colored by lookup table
+
+    Values are quantized to lut_size levels, out of range ones are clipped.
+    Rows are colored by chunks in threads, so only chunk sized
+    temporaries are allocated. Images read on slicing (SpectrogramReader)
+    are read by column strips.
+    """
+
+    if hasattr(image, 'shape') and not isinstance(image, np.ndarray):
+        rgb = np.empty(tuple(image.shape) + (3,), dtype=np.uint8)
+
+        for columns in column_strips(image.shape[1]):
+            rgb[:, columns] = apply_colormap(image[:, columns], cmap,
+                                             lut_size, threads)
+
+        return rgb
+
+    lut = colormap_lut(cmap, lut_size)
+    image = np.asarray(image)
+
+    rgb = np.empty(image.shape + (3,), dtype=np.uint8)
+
+    rows_per_chunk = max(1, COLORMAP_CHUNK_SIZE // max(1, image.shape[-1]))
+    chunks = [
+        slice(start, start + rows_per_chunk)
+        for start in range(0, image.shape[0], rows_per_chunk)
+    ]
+
+    def apply_chunk(rows):
+        # Как в matplotlib: floor(x * size) в пределах таблицы
+        levels = np.multiply(image[rows], lut_size, dtype=np.float32)
+        np.fmax(levels, 0, out=levels)
+        np.fmin(levels, lut_size - 1, out=levels)
+
+        np.take(lut, levels.astype(np.intp), axis=0, out=rgb[rows])
+
+    threads = min(threads or os.cpu_count(), len(chunks))
+
+    if threads > 1:
+        with ThreadPoolExecutor(threads) as executor:
+            list(executor.map(apply_chunk, chunks))
+
+    else:
+        for rows in chunks:
+            apply_chunk(rows)
+
+    return rgb
 
 
 def nolmalize_horizontal_smooth(arr, window_len):
@@ -0,0 +1,154 @@
+"""
+Mipmapped tile pyramid of a spectrogram image
+
+Level 0 is the magnitude image itself, every next level is twice smaller
+in both directions (maximum of 2 x 2 pixels, so short loud events stay
+visible). Levels are built one by one by column strips, so level 0 may
+be a SpectrogramReader which is never read whole, and a viewer can show
+coarse tiles while finer work goes on. Tiles are colored on demand and
+cached.
+"""
+
+from collections import OrderedDict
+import math
+
+import numpy as np
+
+from .media import COLUMN_STRIP_WIDTH, apply_colormap, column_strips
+
+
+TILE_SIZE = 256
+
+# Около 200 Мб раскрашенных тайлов 256 x 256
+TILES_CACHE_SIZE = 1024
+
+
+def test_downsample_max():
+    image = np.arange(15).reshape(3, 5)
+
+    assert downsample_max(image).tolist() == [[6, 8, 9], [11, 13, 14]]
+
+
+def downsample_max(image):
+    """ Maximum over 2 x 2 pixels, odd last row and column are kept """
+
+    for axis in (0, 1):
+        even = image[(slice(None),) * axis + (slice(0, None, 2),)]
+        odd = image[(slice(None),) * axis + (slice(1, None, 2),)]
+
+        halved = np.array(even)
+        pairs = (slice(None),) * axis + (slice(0, odd.shape[axis]),)
+        np.maximum(halved[pairs], odd, out=halved[pairs])
+
+        image = halved
+
+    return image
+
+
+def test_downsample_max_by_strips():
+    image = np.random.RandomState(0).rand(5, 33)
+
+    assert np.array_equal(downsample_max_by_strips(image, strip_width=8),
+                          downsample_max(image))
+
+
+def downsample_max_by_strips(image, strip_width=COLUMN_STRIP_WIDTH):
+    """ downsample_max of image sliced by column strips of even width """
+
+    height, width = image.shape
+    halved = np.empty((-(-height // 2), -(-width // 2)), image.dtype)
+
+    for columns in column_strips(width, strip_width):
+        halved[:, columns.start // 2:-(-columns.stop // 2)] = \
+            downsample_max(image[:, columns])
+
+    return halved
+
+
+def test_tile_pyramid():
+    pyramid = TilePyramid(np.random.RandomState(0).rand(5, 33), tile_size=8)
+
+    assert list(pyramid.build()) == [1, 2, 3]
+    assert [level.shape for level in pyramid.levels] == \
+        [(5, 33), (3, 17), (2, 9), (1, 5)]
+
+    assert pyramid.tiles_count(0) == (1, 5)
+    assert pyramid.tile(0, 0, 4).shape == (5, 1, 3)
+    assert pyramid.tile(0, 0, 4) is pyramid.tile(0, 0, 4)
+
+    assert pyramid.level_for_scale(1) == 0
+    assert pyramid.level_for_scale(0.3) == 1
+    assert pyramid.level_for_scale(0.001) == 3
+
+
+class TilePyramid(object):
+    def __init__(self, abs_image, tile_size=TILE_SIZE, cmap=None,
+                 cache_size=TILES_CACHE_SIZE):
+        self.levels = [abs_image]
+        self.tile_size = tile_size
+        self.cmap = cmap
+        self.cache_size = cache_size
+        self.canceled = False
+
+        self._tiles = OrderedDict()
+
+    @property
+    def height(self):
+        return self.levels[0].shape[0]
+
+    @property
+    def width(self):
+        return self.levels[0].shape[1]
+
+    def build(self):
+        """ Build levels until one tile covers the image, yield each """
+
+        while max(self.levels[-1].shape) > self.tile_size and \
+                not self.canceled:
+            # Добавление в список атомарно, читатели видят готовый уровень
+            self.levels.append(downsample_max_by_strips(self.levels[-1]))
+
+            yield len(self.levels) - 1
+
+    def cancel(self):
+        """ Stop building, levels built so far stay usable """
+
+        self.canceled = True
+
+    def level_for_scale(self, scale):
+        """ Built level with at least one pixel per screen pixel """
+
+        if scale >= 1:
+            return 0
+
+        level = int(math.floor(math.log2(1 / scale)))
+
+        return min(level, len(self.levels) - 1)
+
+    def tiles_count(self, level):
+        rows, columns = self.levels[level].shape
+
+        return -(-rows // self.tile_size), -(-columns // self.tile_size)
+
+    def tile(self, level, row, column):
+        """ RGB uint8 tile, the last in a row or column can be smaller """
+
+        key = (level, row, column)
+
+        if key in self._tiles:
+            self._tiles.move_to_end(key)
+
+            return self._tiles[key]
+
+        size = self.tile_size
+        piece = self.levels[level][row * size:(row + 1) * size,
+                                   column * size:(column + 1) * size]
+
+        tile = apply_colormap(piece, self.cmap, threads=1)
+
+        self._tiles[key] = tile
+
+        if len(self._tiles) > self.cache_size:
+            self._tiles.popitem(last=False)
+
+        return tile
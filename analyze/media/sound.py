@@ -1,3 +1,4 @@
+import hashlib
 import itertools as it
 import logging
 import subprocess as sub
@@ -53,6 +54,17 @@ class Sound(object):
         )
 
 
+def samples_digest(sound, block_size=2 ** 20):
+    """ Hash of samplerate and decoded samples as float64 """
+
+    digest = hashlib.sha1(repr(float(sound.samplerate)).encode('utf-8'))
+
+    for block in sound.get_blocks(block_size):
+        digest.update(np.ascontiguousarray(block, dtype=np.float64).data)
+
+    return digest.hexdigest()
+
+
 class FrequenciesBand(object):
     def __init__(self, lower, upper):
         if lower is not None and upper is not None:
@@ -143,6 +155,10 @@ class SoundFragment(Sound):
 
 
 def one_channel(wav, channel_num=0):
+    if wav.ndim == 1:
+        # Моно
+        return wav
+
     return wav[:, channel_num]
 
 
@@ -165,9 +181,10 @@ class SoundFromSoundFile(Sound):
 
         return one_channel(_samples, 0)
 
-    def get_blocks(self, block_size):
+    def get_blocks(self, block_size, start=0, stop=None):
         # self.blocks_count = (sound_file.frames - 1) // (block_size // 2) + 1
-        blocks = sf.blocks(self._filename, block_size)
+        blocks = sf.blocks(self._filename, block_size, start=start,
+                           stop=stop)
 
         blocks = list(map(one_channel, blocks))
         blocks_count = len(blocks)
@@ -189,8 +206,8 @@ class SoundResampled(Sound):
             self.samples = self.samples[:self.size]
             self.duration = self.size / self.samplerate
 
-    def get_blocks(self, block_size):
-        iter_samples = iter(self.samples)
+    def get_blocks(self, block_size, start=0, stop=None):
+        iter_samples = iter(self.samples[start:stop])
         iblocks = map(lambda _: list(it.islice(iter_samples, block_size)),
                       it.count())
 
@@ -198,3 +215,31 @@ class SoundResampled(Sound):
         blocks_count = len(blocks)
 
         return IterableWithLength(blocks, blocks_count)
+
+
+class StoredSound(Sound):
+    """ Size and samplerate of a sound whose samples are not available """
+
+    def __init__(self, size, samplerate):
+        self.size = size
+        self.samplerate = samplerate
+        self.duration = size / samplerate
+
+    def get_fragment(self, time_band, frequency_band=(None, None)):
+        raise RuntimeError('Samples of a stored spectrogram sound are not '
+                           'available')
+
+
+class LiveSound(Sound):
+    """ Sound growing by pushed chunks, samples are not kept """
+
+    def __init__(self, samplerate):
+        self.samplerate = samplerate
+        self.size = 0
+
+    @property
+    def duration(self):
+        return self.size / self.samplerate
+
+    def extend(self, size):
+        self.size += size
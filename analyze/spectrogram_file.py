@@ -0,0 +1,317 @@
+"""
+Chunked on disk spectrogram with random access
+
+The image (scales x columns) is cut into tiles of chunk_shape, every tile
+is stored separately and optionally compressed with zlib. The file is
+
+    MAGIC, tiles..., JSON header, header offset (uint64 le), MAGIC
+
+Header keeps shape, dtype, chunk shape, compression, frequencies,
+samplerate and decimation of the sound and offsets of the tiles, so any
+time range or frequency band is read without loading the whole file.
+Writer takes columns as they are computed and renames a complete file
+into place.
+"""
+
+import json
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+import numpy as np
+
+
+MAGIC = b'WSMSPEC1'
+
+TRAILER = struct.Struct('<Q')
+
+# Строк (масштабов) и столбцов (отсчетов времени) в одном тайле
+DEFAULT_CHUNK_SHAPE = (64, 4096)
+
+COMPRESSIONS = (None, 'zlib')
+
+
+class SpectrogramWriter(object):
+    def __init__(self, path, height, dtype, frequencies, samplerate,
+                 decimate, sound_size, chunk_shape=DEFAULT_CHUNK_SHAPE,
+                 compression=None):
+        if compression not in COMPRESSIONS:
+            raise ValueError('Unknown compression {!r}'.format(compression))
+
+        self.path = path
+        self.height = height
+        self.dtype = np.dtype(dtype)
+        self.chunk_shape = tuple(chunk_shape)
+        self.compression = compression
+
+        self.header = {
+            'frequencies': [float(f) for f in frequencies],
+            'samplerate': int(samplerate),
+            'decimate': int(decimate),
+            'sound_size': int(sound_size),
+        }
+
+        self.width = 0
+        self._pending = []
+        self._pending_width = 0
+        self._index = []  # Столбец тайлов -> [[смещение, длина], ...]
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, self._tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        self._file = os.fdopen(fd, 'wb')
+        self._file.write(MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+
+        else:
+            self._file.close()
+            os.unlink(self._tmp_path)
+
+    def write(self, columns):
+        """ Append columns (height x n) to the image """
+
+        if columns.shape[0] != self.height:
+            raise ValueError('Expected {} rows, got {}'.format(
+                self.height, columns.shape[0]
+            ))
+
+        self._pending.append(np.asarray(columns, self.dtype))
+        self._pending_width += columns.shape[1]
+
+        chunk_width = self.chunk_shape[1]
+
+        while self._pending_width >= chunk_width:
+            self._write_chunk_column(chunk_width)
+
+    def close(self):
+        if self._pending_width:
+            self._write_chunk_column(self._pending_width)
+
+        header = dict(
+            self.header,
+            shape=[self.height, self.width],
+            dtype=self.dtype.str,
+            chunk_shape=list(self.chunk_shape),
+            compression=self.compression,
+            index=self._index,
+        )
+
+        header_offset = self._file.tell()
+        self._file.write(json.dumps(header).encode('utf-8'))
+        self._file.write(TRAILER.pack(header_offset) + MAGIC)
+        self._file.close()
+
+        os.replace(self._tmp_path, self.path)
+
+    def _write_chunk_column(self, width):
+        pending = np.concatenate(self._pending, axis=1)
+        columns, rest = pending[:, :width], pending[:, width:]
+
+        self._pending = [rest] if rest.shape[1] else []
+        self._pending_width = rest.shape[1]
+
+        chunk_height = self.chunk_shape[0]
+        offsets = []
+
+        for start in range(0, self.height, chunk_height):
+            data = np.ascontiguousarray(
+                columns[start:start + chunk_height]
+            ).tobytes()
+
+            if self.compression == 'zlib':
+                data = zlib.compress(data)
+
+            offsets.append([self._file.tell(), len(data)])
+            self._file.write(data)
+
+        self._index.append(offsets)
+        self.width += width
+
+
+def test_write_and_read_ranges():
+    image = np.random.RandomState(0).rand(10, 37).astype(np.float32)
+
+    for compression in COMPRESSIONS:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.spectrogram')
+
+            with SpectrogramWriter(path, 10, np.float32,
+                                   np.linspace(100, 10, 10), 8000, 4, 148,
+                                   chunk_shape=(4, 8),
+                                   compression=compression) as writer:
+                for start in range(0, 37, 5):
+                    writer.write(image[:, start:start + 5])
+
+            reader = SpectrogramReader(path)
+
+            assert reader.shape == (10, 37)
+            assert reader.decimate == 4
+            assert np.array_equal(reader[:, :], image)
+            assert np.array_equal(reader[3:9, 7:30], image[3:9, 7:30])
+            assert np.array_equal(reader[::3, 35:2:-4], image[::3, 35:2:-4])
+            assert np.array_equal(reader[5], image[5])
+            assert np.array_equal(reader[(slice(0, None, 2),)], image[::2])
+            assert np.array_equal(reader[..., 7], image[..., 7])
+            assert np.array_equal(np.asarray(reader), image)
+            assert reader.samplerate == 8000
+
+            reader.close()
+
+
+class SpectrogramReader(object):
+    """ Image of spectrogram file, numpy slicing reads only needed tiles """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._lock = threading.Lock()
+
+        self._file.seek(-TRAILER.size - len(MAGIC), os.SEEK_END)
+        trailer = self._file.read()
+
+        if not (trailer.endswith(MAGIC) and
+                self._read(0, len(MAGIC)) == MAGIC):
+            raise ValueError('{} is not a spectrogram file'.format(path))
+
+        header_offset, = TRAILER.unpack(trailer[:TRAILER.size])
+        header_size = os.path.getsize(path) - len(trailer) - header_offset
+
+        header = json.loads(
+            self._read(header_offset, header_size).decode('utf-8')
+        )
+
+        self.shape = tuple(header['shape'])
+        self.dtype = np.dtype(header['dtype'])
+        self.chunk_shape = tuple(header['chunk_shape'])
+        self.compression = header['compression']
+        self.frequencies = np.array(header['frequencies'])
+        self.samplerate = header['samplerate']
+        self.decimate = header['decimate']
+        self.sound_size = header['sound_size']
+        self._index = header['index']
+
+    def close(self):
+        self._file.close()
+
+    def __array__(self, dtype=None, copy=None):
+        image = self[:, :]
+
+        return image if dtype is None else image.astype(dtype, copy=False)
+
+    def __getitem__(self, key):
+        key = full_key(key, len(self.shape))
+
+        squeeze = tuple(
+            axis for axis, item in enumerate(key)
+            if not isinstance(item, slice)
+        )
+
+        rows, columns = [
+            to_range(item, size) for item, size in zip(key, self.shape)
+        ]
+
+        if not len(rows) or not len(columns):
+            return np.zeros((len(rows), len(columns)), self.dtype)
+
+        first_row, last_row = min(rows), max(rows) + 1
+        first_column, last_column = min(columns), max(columns) + 1
+
+        block = self.read_block(first_row, last_row,
+                                first_column, last_column)
+
+        block = block[relative_slice(rows, first_row),
+                      relative_slice(columns, first_column)]
+
+        return block.squeeze(axis=squeeze) if squeeze else block
+
+    def read_block(self, first_row, last_row, first_column, last_column):
+        """ Contiguous rectangle of the image """
+
+        chunk_height, chunk_width = self.chunk_shape
+
+        block = np.empty((last_row - first_row, last_column - first_column),
+                         self.dtype)
+
+        for chunk_column in range(first_column // chunk_width,
+                                  -(-last_column // chunk_width)):
+            for chunk_row in range(first_row // chunk_height,
+                                   -(-last_row // chunk_height)):
+                chunk = self._chunk(chunk_row, chunk_column)
+
+                top = chunk_row * chunk_height
+                left = chunk_column * chunk_width
+
+                # Пересечение тайла с прямоугольником
+                rows = slice(max(first_row, top),
+                             min(last_row, top + chunk.shape[0]))
+                columns = slice(max(first_column, left),
+                                min(last_column, left + chunk.shape[1]))
+
+                block[rows.start - first_row:rows.stop - first_row,
+                      columns.start - first_column:
+                      columns.stop - first_column] = \
+                    chunk[rows.start - top:rows.stop - top,
+                          columns.start - left:columns.stop - left]
+
+        return block
+
+    def _chunk(self, chunk_row, chunk_column):
+        chunk_height, chunk_width = self.chunk_shape
+
+        offset, length = self._index[chunk_column][chunk_row]
+        data = self._read(offset, length)
+
+        if self.compression == 'zlib':
+            data = zlib.decompress(data)
+
+        height = min(chunk_height, self.shape[0] - chunk_row * chunk_height)
+
+        return np.frombuffer(data, self.dtype).reshape(height, -1)
+
+    def _read(self, offset, length):
+        with self._lock:
+            self._file.seek(offset)
+
+            return self._file.read(length)
+
+
+def full_key(key, ndim):
+    """ Key with a slice or an index for every axis """
+
+    if not isinstance(key, tuple):
+        key = (key,)
+
+    if Ellipsis in key:
+        index = key.index(Ellipsis)
+        key = key[:index] + (slice(None),) * (ndim - len(key) + 1) + \
+            key[index + 1:]
+
+    if len(key) > ndim:
+        raise IndexError('Too many indices for {} dimensions'.format(ndim))
+
+    return key + (slice(None),) * (ndim - len(key))
+
+
+def to_range(item, size):
+    if isinstance(item, slice):
+        return range(*item.indices(size))
+
+    index = range(size)[item]
+
+    return range(index, index + 1)
+
+
+def relative_slice(indexes, origin):
+    """ Slice selecting indexes from an array starting at origin """
+
+    stop = indexes.stop - origin
+
+    return slice(indexes.start - origin, stop if stop >= 0 else None,
+                 indexes.step)
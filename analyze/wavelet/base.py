@@ -1,170 +1,702 @@
 from functools import partial
-from itertools import chain, tee
+from itertools import islice
 import logging
 
 import numpy as np
+import scipy.signal
 
 log = logging.getLogger(__name__)
 
 
 PI2 = 2 * np.pi
 
+# Увеличивается, когда меняются результаты преобразования
+CWT_VERSION = 1
 
-def pairwise(iterable):
-    one, two = tee(iterable)
-    next(two, None)
-    return zip(one, two)
 
+# Вещественный и комплексный типы для точности вычислений
+PRECISIONS = {
+    'single': (np.float32, np.complex64),
+    'double': (np.float64, np.complex128),
+}
 
-def grouper(iterable, n):
-    return zip(*([iter(iterable)] * n))
 
+def precision_dtypes(precision):
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision {!r}, choose one of {}'.format(
+            precision, ', '.join(PRECISIONS)
+        ))
 
-def test_split_vertical():
-    i, j = split_vertical([[1, 2], [3, 4]])
-    assert i.tolist() == [[1], [3]]
-    assert j.tolist() == [[2], [4]]
+    return PRECISIONS[precision]
 
 
-def split_vertical(mat):
-    mat = np.asarray(mat)
-    half = mat.shape[1] / 2
-    return mat[:, :half], mat[:, half:]
+def is_power_of_two(val):
+    return val and val & (val - 1) == 0
 
 
-def test_iconcatenate_pairs():
-    pairs = [[1, 2, 3], [4, 5, 6], [7, 8, 9]]
-    assert [list(r) for r in iconcatenate_pairs(pairs)] == \
-        [
-            [1, 2, 3, 4, 5, 6],
-            [4, 5, 6, 7, 8, 9],
-    ]
+# Окно, сумма сдвигов которого местами меньше этой доли от максимума,
+# слишком усиливает края блоков при нормировке
+MIN_WINDOW_SUM = 0.01
 
 
-def iconcatenate_pairs(items):
-    for pair in pairwise(items):
-        yield np.concatenate(pair)
+def test_overlap_add_window():
+    hann = overlap_add_window('hann', 8, 4)
+    assert np.allclose(hann[:4] + hann[4:], 1)
 
+    window = overlap_add_window('hamming', 8, 2)
+    assert np.allclose(window.reshape(4, 2).sum(axis=0), 1)
 
-def is_power_of_two(val):
-    return val and val & (val - 1) == 0
+    try:
+        overlap_add_window('hann', 8, 8)
+    except ValueError:
+        pass
+    else:
+        assert False, 'Hann window without overlap must be rejected'
+
+
+def overlap_add_window(window, nsamples, hop, dtype=np.float64):
+    """
+    Window divided by the sum of its copies shifted by hop
+
+    Overlap added windowed pieces then sum up to the signal exactly.
+    """
+
+    window = scipy.signal.get_window(window, nsamples)
+
+    window_sum = np.zeros(hop)
+    for start in range(0, nsamples, hop):
+        piece = window[start:start + hop]
+        window_sum[:len(piece)] += piece
+
+    if window_sum.min() < MIN_WINDOW_SUM * window_sum.max():
+        raise ValueError('Window does not cover the signal with hop {}'.
+                         format(hop))
+
+    window /= window_sum[np.arange(nsamples) % hop]
 
+    return window.astype(dtype)
 
-def gen_halfs(arrays, size):
-    halfsize = size // 2
 
-    for array in arrays:
-        pair = split_array(array, halfsize)
+def test_block_layout_pieces_sum_up_to_signal():
+    signal = np.random.RandomState(0).randn(37)
 
-        for j in filter(len, pair):
-            yield j
+    for overlap, window in [(1/2, 'hann'), (3/4, 'blackman'), (0, 'boxcar'),
+                            (1/4, 'hamming')]:
+        layout = BlockLayout(8, overlap, window)
+        pieces = list(layout.pieces([signal[:20], signal[20:]]))
 
+        assert len(pieces) == layout.pieces_count(len(signal))
 
-def test_gen_halfs():
-    d = [ [1,2,3,4], [5,6,7], ]
+        total = np.zeros((len(pieces) - 1) * layout.hop + 8)
+        for index, piece in enumerate(pieces):
+            total[index * layout.hop:][:8] += piece
 
-    assert list(gen_halfs(d, 4)) == [[1, 2], [3, 4], [5, 6], [7]]
+        assert layout.size == len(signal)
+        assert np.allclose(total[layout.lead:][:len(signal)], signal)
 
 
-def split_array(array, where):
-    return array[:where], array[where:]
+def test_block_layout_aligns_overlap():
+    layout = BlockLayout(2 ** 17, 0.3, align=64)
 
+    assert layout.hop % 64 == 0 and layout.lead % 64 == 0
+    assert abs(layout.lead - 0.3 * 2 ** 17) <= 32
+    assert BlockLayout(8, 0.99, align=4).hop == 4
 
-def map_only_last(fn, iterable):
-    items = iter(iterable)
-    last = next(items)
 
-    for elem in items:
-        yield last
-        last = elem
+def test_block_layout_pieces_of_range():
+    signal = np.random.RandomState(0).randn(37)
+    layout = BlockLayout(8, 3/4)
+    pieces = list(layout.pieces([signal]))
+
+    for start, stop in [(0, 37), (11, 12), (20, 37), (3, 30)]:
+        indexes = layout.pieces_range(start, stop)
+        samples = layout.samples_range(indexes)
+
+        # Соседние куски уже не касаются отсчетов start..stop
+        assert indexes.stop <= len(pieces)
+        assert indexes.stop * layout.hop - layout.lead >= stop
+        assert indexes.start == 0 or samples.start - layout.hop + 8 <= start
+
+        part = layout.pieces([signal[max(samples.start, 0):samples.stop]],
+                             lead=max(0, -samples.start))
+
+        for index, piece in zip(indexes, part):
+            assert np.array_equal(piece, pieces[index])
+
+
+class BlockLayout(object):
+    """
+    Overlapped windowed pieces of nsamples cut from a stream of blocks
+
+    Piece k starts at k * hop of the signal preceded by lead zeros, so every
+    sample is covered by the same number of pieces. Overlap is rounded to
+    a multiple of align samples, so decimated pieces keep whole columns.
+    """
+
+    def __init__(self, nsamples, overlap=1/2, window='hann',
+                 dtype=np.float64, align=1):
+        if not 0 <= overlap < 1:
+            raise ValueError('overlap must be in [0, 1)')
+
+        self.nsamples = nsamples
+        self.lead = min(int(round(nsamples * overlap / align)) * align,
+                        nsamples - align)
+        self.hop = nsamples - self.lead
+        self.window = overlap_add_window(window, nsamples, self.hop, dtype)
+        self.dtype = dtype
+        self.size = None
 
-    yield fn(last)
+    def pieces_count(self, size, lead=None):
+        lead = self.lead if lead is None else lead
 
+        return (lead + size - 1) // self.hop + 1 if size else 0
 
-def test_map_only_last():
-    mapped = map_only_last(lambda x: x+1, range(3))
+    def pieces_range(self, start, stop):
+        """ Indexes of pieces overlapping samples start..stop """
 
-    assert list(mapped) == [0, 1, 3]
+        first = max(0, (start + self.lead - self.nsamples) // self.hop + 1)
+        last = (stop + self.lead - 1) // self.hop + 1
 
+        return range(first, max(first, last))
+
+    def samples_range(self, pieces):
+        """ Samples under pieces, negative ones are lead zeros """
+
+        return range(pieces.start * self.hop - self.lead,
+                     (pieces.stop - 1) * self.hop - self.lead + self.nsamples)
+
+    def pieces(self, blocks, lead=None):
+        """
+        Windowed pieces, size of the signal is known when exhausted
+
+        Blocks of a part of the signal are preceded by lead zeros instead,
+        pieces start at its first sample.
+        """
+        lead = self.lead if lead is None else lead
+
+        buffer = np.zeros(lead, self.dtype)
+        size = count = 0
+
+        for block in blocks:
+            size += len(block)
+            buffer = np.concatenate([buffer,
+                                     np.asarray(block, self.dtype)])
+
+            while len(buffer) >= self.nsamples:
+                yield buffer[:self.nsamples] * self.window
+                buffer = buffer[self.hop:]
+                count += 1
 
-class NumpyPadder(object):
-    def __init__(self, size):
         self.size = size
 
-    def __call__(self, array):
-        self.original_size = len(array)
-        self.pad_size = self.size - self.original_size
+        # Дополняем нулями до конца последнего куска
+        tail_count = self.pieces_count(size, lead) - count
+        buffer = np.pad(buffer,
+                        (0, (tail_count - 1) * self.hop + self.nsamples))
+
+        for index in range(tail_count):
+            start = index * self.hop
+            yield buffer[start:start + self.nsamples] * self.window
+
+
+class OverlapAdd(object):
+    """
+    Sum of overlapped piece images, columns are taken out when final
+
+    Piece images are consecutive and shifted by hop_width columns, the
+    first lead_width columns of the sum are dropped.
+    """
+
+    def __init__(self, hop_width, lead_width):
+        self.hop_width = hop_width
+        self.lead_width = lead_width
+        self.column = 0
+        self.tail = None
+
+    def add(self, image):
+        """ Add next piece image (modified in place), return final columns """
+
+        if self.tail is not None:
+            image[:, :self.tail.shape[1]] += self.tail
+
+        chunk, self.tail = image[:, :self.hop_width], image[:, self.hop_width:]
+
+        # Столбцы ведущих нулей отбрасываем
+        skip = max(0, self.lead_width - self.column)
+        self.column += self.hop_width
+
+        return chunk[:, skip:]
+
+
+def test_add_columns():
+    out = np.zeros((1, 4))
+
+    add_columns(out, np.ones((1, 3)), -1)
+    add_columns(out, np.full((1, 3), 2.), 3)
+
+    assert np.array_equal(out, [[1, 1, 0, 2]])
+
+
+def add_columns(out, image, offset):
+    """ Add piece image starting at column offset of out, clipped to out """
+
+    # Столбцы куска в координатах результата
+    first = max(offset, 0)
+    last = min(offset + image.shape[1], out.shape[1])
+
+    if first < last:
+        out[:, first:last] += image[:, first - offset:last - offset]
+
+
+def test_spectra_cache_keeps_limit():
+    class Box(object):
+        calls = 0
+
+        def spectrum(self, data):
+            self.calls += 1
+            return data * 2
+
+    box = Box()
+    spectra = SpectraCache(limit=16)
+    pieces = [np.full(1, index, np.float64) for index in range(3)]
+
+    assert [s[0] for s in spectra.iter_spectra(box, pieces)] == [0, 2, 4]
+    assert [s[0] for s in spectra.iter_spectra(box, pieces[1:], 1)] == [2, 4]
+    assert box.calls == 4 and spectra.nbytes == 16
+
+
+class SpectraCache(object):
+    """
+    Spectra of pieces shared by passes of boxes with other scales
+
+    Spectra are kept by piece index while their bytes fit into limit,
+    the rest are computed again by every pass.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.nbytes = 0
+        self._spectra = {}
+
+    def iter_spectra(self, wbox, pieces, start=0):
+        """ Spectra of pieces numbered from start """
+
+        for index, piece in enumerate(pieces, start):
+            spectrum = self._spectra.get(index)
+
+            if spectrum is None:
+                spectrum = wbox.spectrum(piece)
+
+                if self.nbytes + spectrum.nbytes <= self.limit:
+                    self._spectra[index] = spectrum
+                    self.nbytes += spectrum.nbytes
+
+            yield spectrum
+
+
+OUTPUTS = ('complex', 'magnitude', 'power', 'db')
+
+
+def check_output(output):
+    if output not in OUTPUTS:
+        raise ValueError('Unknown output {!r}, choose one of {}'.format(
+            output, ', '.join(OUTPUTS)
+        ))
+
+
+def test_reduce_columns():
+    chunk = np.array([[3 + 4j, 0]], dtype=np.complex64)
+    out = np.empty(chunk.shape, np.float32)
+
+    assert reduce_columns(chunk, 'magnitude', out).tolist() == [[5, 0]]
+    assert reduce_columns(chunk, 'power', out).tolist() == [[25, 0]]
+
+    db = reduce_columns(chunk, 'db', out)
+    assert np.isclose(db[0, 0], 20 * np.log10(5)) and np.isfinite(db).all()
+
+
+def reduce_columns(chunk, output, out):
+    """ Magnitude, power or decibels of complex chunk into real out """
+
+    np.abs(chunk, out=out)
+
+    if output == 'power':
+        np.square(out, out=out)
+
+    elif output == 'db':
+        # Без -inf для нулей
+        np.maximum(out, np.finfo(out.dtype).tiny, out=out)
+        np.log10(out, out=out)
+        out *= 20
+
+    return out
+
+
+def test_smallest_block_size():
+    size = smallest_block_size(100, 8000, 1/16, 70)
+
+    assert lowest_frequency(size, 8000, 1/16, 70) <= 100
+    assert lowest_frequency(size // 2, 8000, 1/16, 70) > 100
+
+
+def smallest_block_size(frequency, samplerate, scale_resolution, omega0,
+                        max_size=2 ** 24):
+    """ Smallest power of two block whose scales reach down to frequency """
+
+    size = 2
+    while lowest_frequency(size, samplerate, scale_resolution, omega0) > \
+            frequency:
+        size *= 2
+
+        if size > max_size:
+            raise ValueError('No block up to {} samples reaches {} Hz'.
+                             format(max_size, frequency))
 
-        if self.pad_size == 0:
-            return array
+    return size
 
-        elif self.pad_size > 0:
-            return np.pad(array, (0, self.pad_size), 'constant')
 
-        assert False  # Should never come here
-        raise Exception('Pad size < 0')
+def lowest_frequency(nsamples, samplerate, scale_resolution, omega0):
+    scales = autoscales(nsamples, samplerate, scale_resolution, omega0)
+
+    if not len(scales):
+        # Блок короче базового вейвлета
+        return np.inf
+
+    return scale_to_frequency(scales[-1], omega0)
+
+
+def scale_to_frequency(scales, omega0):
+    # Set coefficient in accordance with wavelet type
+    return 11 * (omega0 / 70) / scales
+
+
+def test_frequency_rows():
+    frequencies = np.array([800, 400, 200, 100])
+
+    assert frequency_rows(frequencies, 150, 500) == slice(1, 3)
+    assert frequency_rows(frequencies, None, 300) == slice(2, 4)
+    assert frequency_rows(frequencies, 900, None) == slice(0, 0)
+
+
+def frequency_rows(frequencies, lower=None, upper=None):
+    """ Rows with frequencies in lower..upper Hz, bounds may be None """
+
+    inside = np.ones(len(frequencies), dtype=bool)
+
+    if lower is not None:
+        inside &= frequencies >= lower
+
+    if upper is not None:
+        inside &= frequencies <= upper
+
+    rows = np.flatnonzero(inside)
+
+    if not len(rows):
+        return slice(0, 0)
+
+    return slice(int(rows[0]), int(rows[-1]) + 1)
 
 
 class BaseWaveletBox(object):
-    def __init__(self, nsamples, samplerate, scale_resolution, omega0):
+    def __init__(self, nsamples, samplerate, scale_resolution, omega0,
+                 precision='single'):
         if not is_power_of_two(nsamples):
             raise Exception(u'nsamples must be power of two')
 
+        self.precision = precision
+        self.real_dtype, self.complex_dtype = precision_dtypes(precision)
+
         self.nsamples = nsamples
+        self.samplerate = samplerate
+        self.scale_resolution = scale_resolution
         self.omega0 = omega0
         self.scales = autoscales(nsamples, samplerate,
-                                 scale_resolution, omega0)
-        self.angular_frequencies = angularfreq(nsamples, samplerate)
+                                 scale_resolution, omega0, self.real_dtype)
+        self.angular_frequencies = angularfreq(nsamples, samplerate,
+                                               self.real_dtype)
 
     @property
     def frequencies(self):
-        # Set coefficient in accordance with wavelet type
-        return 11 * (self.omega0 / 70) / self.scales
+        return scale_to_frequency(self.scales, self.omega0)
+
+    @property
+    def nbytes(self):
+        """ Memory held by filters """
+        return nbytes(getattr(self, 'wft', ()))
+
+    def close(self):
+        """ Free resources held by the box """
+
+    def stop_workers(self):
+        """ Stop workers of an unused box, next cwt starts them again """
+
+    def spectrum(self, data):
+        """
+        Forward transform of a piece for cwt_spectrum, backends which
+        split cwt keep it reusable by boxes with other scales
+        """
+        return data
+
+    def cwt_spectrum(self, spectrum, decimate=None, rows=None):
+        return self.cwt(spectrum, decimate, rows=rows)
 
     def sound_apply_cwt(self, sound, progressbar, **kwargs):
         blocks = sound.get_blocks(self.nsamples)
-        # blocks = sound.get_blocks(self.nsamples//2)
 
         with progressbar(blocks) as blocks_:
-            return self._apply_cwt(blocks_, progressbar, **kwargs)
+            return self._apply_cwt(blocks_, progressbar, size=sound.size,
+                                   **kwargs)
 
-    def _apply_cwt(self, blocks, progressbar, decimate, **kwargs):
-        half_nsamples = self.nsamples // 2
+    def sound_iter_cwt(self, sound, progressbar, **kwargs):
+        blocks = sound.get_blocks(self.nsamples)
 
-        chunks = gen_halfs(blocks, self.nsamples)
+        with progressbar(blocks) as blocks_:
+            yield from self._iter_cwt(blocks_, **kwargs)
 
-        padder = NumpyPadder(half_nsamples)
+    def sound_apply_region_cwt(self, sound, progressbar, start, stop,
+                               rows=None, decimate=None, overlap=1/2,
+                               window='hann', output='complex', **kwargs):
+        """
+        Part of sound_apply_cwt image: columns of samples start..stop
+        (from start // decimate) and scales rows
 
-        equal_sized_pieces = map_only_last(padder, chunks)
+        Only blocks of the pieces overlapping the range are read and only
+        rows are transformed, so the work is proportional to the region.
+        """
+        check_output(output)
 
-        zero_pad = np.zeros(half_nsamples)
-        overlapped_blocks = iconcatenate_pairs(
-            chain([zero_pad], equal_sized_pieces, [zero_pad])
+        decimate = decimate or 1
+        layout = self.block_layout(overlap, window, decimate)
+
+        first_row, last_row, _ = (rows or slice(None)).indices(
+            len(self.scales)
         )
+        rows = slice(first_row, max(first_row, last_row))
+
+        stop = min(stop, sound.size)
+        first_column = start // decimate
+        width = max(0, min(-(-stop // decimate), sound.size // decimate) -
+                    first_column)
+
+        complex_image = np.zeros((rows.stop - rows.start, width),
+                                 self.complex_dtype)
+
+        indexes = layout.pieces_range(start, stop)
+
+        # Полоса без масштабов: блоки не читаем
+        if width and len(indexes) and rows.start < rows.stop:
+            samples = layout.samples_range(indexes)
+            blocks = sound.get_blocks(self.nsamples,
+                                      start=max(samples.start, 0),
+                                      stop=min(samples.stop, sound.size))
+
+            with progressbar(blocks) as blocks_:
+                pieces = islice(
+                    layout.pieces(blocks_, lead=max(0, -samples.start)),
+                    len(indexes)
+                )
+                images = self._iter_block_images(pieces, decimate,
+                                                 rows=rows, **kwargs)
+
+                for index, image in zip(indexes, images):
+                    offset = (index * layout.hop - layout.lead) // decimate
+                    add_columns(complex_image, image, offset - first_column)
+
+        if output == 'complex':
+            return complex_image
+
+        return reduce_columns(complex_image, output,
+                              np.empty(complex_image.shape, self.real_dtype))
+
+    def _apply_cwt(self, blocks, progressbar, decimate, size,
+                   overlap=1/2, window='hann', output='complex',
+                   checkpoint=None, spectra=None, **kwargs):
+        """
+        Piece images are added straight into their columns of output
+
+        spectra is a SpectraCache of pieces kept between calls.
+        """
+        if output != 'complex' or checkpoint is not None:
+            return self._apply_streamed_cwt(blocks, decimate, size, overlap,
+                                            window, output, checkpoint,
+                                            spectra=spectra, **kwargs)
+
+        decimate = decimate or 1
+        layout = self.block_layout(overlap, window, decimate)
+
+        hop_width = layout.hop // decimate
+        lead_width = layout.lead // decimate
+        width = size // decimate
+
+        images = self._iter_piece_images(layout.pieces(blocks), decimate,
+                                         spectra, **kwargs)
+
+        complex_image = np.zeros((len(self.scales), width),
+                                 self.complex_dtype)
+
+        for index, image in enumerate(images):
+            add_columns(complex_image, image, index * hop_width - lead_width)
+
+        return complex_image
+
+    def _apply_streamed_cwt(self, blocks, decimate, size, overlap, window,
+                            output, checkpoint=None, **kwargs):
+        """
+        Image is filled by final columns, real ones are reduced at once
+
+        Overlapped pieces are summed in complex (magnitude of a sum is not
+        a sum of magnitudes), so just one piece is kept complex.
+        """
+        check_output(output)
+
+        dtype = self.complex_dtype if output == 'complex' \
+            else self.real_dtype
+        image = np.empty((len(self.scales), size // (decimate or 1)), dtype)
+        column = 0
+
+        for chunk in self._iter_complex_cwt(blocks, decimate, overlap,
+                                            window, checkpoint, **kwargs):
+            columns = image[:, column:column + chunk.shape[1]]
+
+            if output == 'complex':
+                columns[...] = chunk
+
+            else:
+                reduce_columns(chunk, output, columns)
+
+            column += chunk.shape[1]
+
+        return image[:, :column]
+
+    def _iter_cwt(self, blocks, decimate, overlap=1/2, window='hann',
+                  output='complex', checkpoint=None, **kwargs):
+        """ Yield image by hop sized chunks, reduced to output """
+
+        chunks = self._iter_complex_cwt(blocks, decimate, overlap, window,
+                                        checkpoint, **kwargs)
+
+        if output == 'complex':
+            yield from chunks
+            return
+
+        check_output(output)
+
+        for chunk in chunks:
+            yield reduce_columns(chunk, output,
+                                 np.empty(chunk.shape, self.real_dtype))
+
+    def _iter_complex_cwt(self, blocks, decimate, overlap, window,
+                          checkpoint=None, **kwargs):
+        """
+        Yield complex image by hop sized chunks
+
+        Each chunk is yielded as soon as all overlapped pieces covering
+        it are transformed, so only about two piece images are kept.
+        With checkpoint pieces saved by an interrupted run are not
+        transformed again.
+        """
+        decimate = decimate or 1
+        layout = self.block_layout(overlap, window, decimate)
+
+        overlap_add = OverlapAdd(layout.hop // decimate,
+                                 layout.lead // decimate)
+
+        chunks = self._iter_overlap_added(layout, overlap_add, blocks,
+                                          decimate, checkpoint, **kwargs)
+
+        ready = None
+        emitted = 0
+
+        for chunk in chunks:
+            if chunk.shape[1]:
+                if ready is not None:
+                    yield ready
+                    emitted += ready.shape[1]
+
+                ready = chunk
+
+        if ready is not None:
+            # Cut pad size from last
+            yield ready[:, :layout.size // decimate - emitted]
+
+    def _iter_overlap_added(self, layout, overlap_add, blocks, decimate,
+                            checkpoint=None, spectra=None, **kwargs):
+        """ Final columns of every piece, saved ones are read back """
+
+        pieces = layout.pieces(blocks)
+        done = 0
+
+        if checkpoint is not None:
+            done = checkpoint.restore(overlap_add)
+            yield from checkpoint.chunks()
+
+            # Отсчеты готовых кусков только пропускаем
+            pieces = islice(pieces, done, None)
+
+        images = self._iter_piece_images(pieces, decimate, spectra, done,
+                                         **kwargs)
+
+        for index, image in enumerate(images, done):
+            chunk = overlap_add.add(image)
+
+            # Куски после конца блоков дополнены нулями, а при отмене
+            # блоки обрываются раньше конца звука, такие не сохраняем
+            if checkpoint is not None and layout.size is None:
+                checkpoint.save(index, chunk, overlap_add)
+
+            yield chunk
+
+    def _iter_piece_images(self, pieces, decimate, spectra=None, start=0,
+                           **kwargs):
+        """ Images of pieces numbered from start, spectra from cache """
+
+        if spectra is None:
+            return self._iter_block_images(pieces, decimate, **kwargs)
+
+        return self._iter_block_images(
+            spectra.iter_spectra(self, pieces, start), decimate,
+            transformed=True, **kwargs
+        )
+
+    def _iter_block_images(self, pieces, decimate, transformed=False,
+                           **kwargs):
+        """ transformed pieces are spectra made by spectrum """
+
+        transform = self.cwt_spectrum if transformed else self.cwt
+
+        for windowed_piece in pieces:
+            yield transform(windowed_piece, decimate, **kwargs)
+
+    def block_layout(self, overlap, window, decimate):
+        layout = BlockLayout(self.nsamples, overlap, window, self.real_dtype,
+                             align=decimate)
+
+        if self.nsamples % decimate:
+            raise ValueError('decimate {} does not divide block {}'.
+                             format(decimate, self.nsamples))
+
+        return layout
+
 
-        windowed_pieces = overlapped_blocks * np.hanning(self.nsamples)
+def test_nbytes():
+    assert nbytes([np.zeros(2), (np.zeros(3), 4)]) == 40
 
-        complex_images = [
-            self.cwt(windowed_piece, decimate, **kwargs)
-            for windowed_piece in windowed_pieces
-        ]
 
-        halfs = chain.from_iterable(map(split_vertical, complex_images))
-        next(halfs)
-        overlapped_halfs = [left + right for left, right in grouper(halfs, 2)]
+def nbytes(filters):
+    if hasattr(filters, 'nbytes'):
+        return filters.nbytes
 
-        # Cut pad size from last
-        last_image_size = padder.original_size // decimate
-        overlapped_halfs[-1] = overlapped_halfs[-1][:, :last_image_size]
+    if isinstance(filters, (list, tuple)):
+        return sum(map(nbytes, filters))
 
-        return np.concatenate(overlapped_halfs, axis=1)
+    return 0
 
 
-def angularfreq(nsamples, samplerate):
+def angularfreq(nsamples, samplerate, dtype=np.float32):
     """ Compute angular frequencies """
 
-    angfreq = np.arange(nsamples, dtype=np.float32)
-    angfreq[-nsamples/2 + 1:] -= nsamples
+    angfreq = np.arange(nsamples, dtype=dtype)
+    angfreq[-nsamples // 2 + 1:] -= nsamples
     angfreq *= samplerate * PI2 / nsamples
 
     return angfreq
@@ -174,7 +706,8 @@ def angularfreq(nsamples, samplerate):
 LOWER_FQ_LIMIT_COEFF = 0.5
 
 
-def autoscales(samples_count, samplerate, scale_resolution, omega0):
+def autoscales(samples_count, samplerate, scale_resolution, omega0,
+               dtype=np.float32):
     """ Compute scales as fractional power of two """
 
     # morle_samples - количество отсчетов для базового вейвлета
@@ -194,7 +727,7 @@ def autoscales(samples_count, samplerate, scale_resolution, omega0):
 
     indexes_count = int(np.floor(maximal_scale / scale_resolution))
 
-    indexes = np.arange(indexes_count + 1, dtype=np.float32)
+    indexes = np.arange(indexes_count + 1, dtype=dtype)
     logarithmic_indexes = 2 ** (indexes * scale_resolution)
 
-    return minimal_scale * logarithmic_indexes
+    return (minimal_scale * logarithmic_indexes).astype(dtype)
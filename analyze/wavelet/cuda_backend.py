@@ -43,7 +43,11 @@ multiply_them = ElementwiseKernel(
 
 class WaveletBox(BaseWaveletBox):
 
-    def __init__(self, nsamples, samplerate, scale_resolution, omega0):
+    def __init__(self, nsamples, samplerate, scale_resolution, omega0,
+                 precision='single'):
+        if precision != 'single':
+            raise ValueError('CUDA backend supports only single precision')
+
         super(WaveletBox, self). \
             __init__(nsamples, samplerate, scale_resolution, omega0)
 
@@ -54,11 +58,11 @@ class WaveletBox(BaseWaveletBox):
 
         self.plan = Plan((nsamples,), stream=stream)
 
-    def cwt(self, data, decimate=None):
+    def cwt(self, data, decimate=None, rows=None):
         x_arr = np.asarray(data, dtype=np.complex64) - np.mean(data)
         x_width = x_arr.shape[0]
 
-        if x_arr.ndim is not 1:
+        if x_arr.ndim != 1:
             raise ValueError('data must be an 1d numpy array or list')
 
         assert x_arr.shape[0] == self.nsamples
@@ -69,7 +73,10 @@ class WaveletBox(BaseWaveletBox):
         else:
             result_width = self.nsamples
 
-        complex_image = np.empty((self.scales.shape[0], result_width),
+        first, last, _ = (rows or slice(None)).indices(self.scales.shape[0])
+        last = max(first, last)
+
+        complex_image = np.empty((last - first, result_width),
                                  dtype=np.complex64)
 
         gpu_x_arr_ft = gpuarray.to_gpu(x_arr)
@@ -77,7 +84,7 @@ class WaveletBox(BaseWaveletBox):
 
         gpu_med = gpuarray.empty_like(gpu_x_arr_ft)
 
-        for i in range(complex_image.shape[0]):
+        for i in range(first, last):
             multiply_them(gpu_med, gpu_x_arr_ft, self.wft[i])
 
             self.plan.execute(gpu_med, inverse=True)
@@ -88,10 +95,10 @@ class WaveletBox(BaseWaveletBox):
 
                 gpu_decimated = extract_columns(reshaped, 0, 1).ravel()
 
-                complex_image[i] = gpu_decimated.get()
+                complex_image[i - first] = gpu_decimated.get()
 
             else:
-                complex_image[i] = gpu_med.get()
+                complex_image[i - first] = gpu_med.get()
 
         return complex_image
 
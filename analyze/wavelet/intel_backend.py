@@ -1,113 +1,434 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import os
+
 import numpy as np
-import py
+import scipy.fft
 
+from ..cache import DiskCache
 from .base import BaseWaveletBox, PI2
 
 
+# Ограничение памяти под промежуточное произведение одной группы масштабов
+DEFAULT_MEMORY_LIMIT = 256 * 2 ** 20
+
+FILTERS_CACHE = DiskCache('filters', size_limit=2 * 2 ** 30)
+
+
 class WaveletBox(BaseWaveletBox):
 
-    def __init__(self, nsamples, samplerate, scale_resolution, omega0):
+    def __init__(self, nsamples, samplerate, scale_resolution, omega0,
+                 memory_limit=DEFAULT_MEMORY_LIMIT, threads=1,
+                 cache_filters=True, epsilon=0, precision='single'):
+        """
+        Filter values below epsilon times their peak are dropped,
+        with zero epsilon only exact zeros are.
+        """
         super(WaveletBox, self). \
-            __init__(nsamples, samplerate, scale_resolution, omega0)
+            __init__(nsamples, samplerate, scale_resolution, omega0,
+                     precision)
+
+        self.cache_filters = cache_filters
+        self.epsilon = epsilon
+        self.wft = self._morlet_ft_box(samplerate)
+
+        self.threads = threads or os.cpu_count()
+
+        # Каждый поток держит в памяти свою группу масштабов
+        self.group_size = min(
+            scales_group_size(nsamples, memory_limit // self.threads,
+                              self.complex_dtype),
+            -(-self.scales.shape[0] // self.threads)
+        )
+
+        if self.threads > 1:
+            self._executor = ThreadPoolExecutor(self.threads)
+
+        else:
+            self._executor = None
+
+    def _morlet_ft_box(self, samplerate):
+        def compute():
+            return morlet_ft_packed(
+                self.scales, self.angular_frequencies, self.omega0,
+                samplerate, self.epsilon, self.real_dtype
+            ).arrays()
+
+        if not self.cache_filters:
+            return PackedFilters(**compute())
+
+        key = ('morlet_ft_packed', self.nsamples, float(samplerate),
+               float(self.scale_resolution), float(self.omega0),
+               float(self.epsilon), np.dtype(self.real_dtype).name)
+
+        # Файл отображается в память и общий для всех процессов
+        return PackedFilters(**FILTERS_CACHE.cached(key, compute))
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+
+    def cwt(self, data, decimate=None, rows=None):
+        """ rows is a slice of scales to transform, all by default """
+
+        return self.cwt_spectrum(self.spectrum(data), decimate, rows)
+
+    def cwt_spectrum(self, x_arr_ft, decimate=None, rows=None):
+        decimate = decimate or 1
+        result_width = len(range(0, self.nsamples, decimate))
+
+        first, last, _ = (rows or slice(None)).indices(self.scales.shape[0])
+        last = max(first, last)
+
+        complex_image = np.empty((last - first, result_width),
+                                 dtype=self.complex_dtype)
+
+        # Части строк тоже делятся между всеми потоками
+        group_size = min(self.group_size,
+                         max(1, -(-(last - first) // self.threads)))
+
+        groups = [
+            slice(start, min(start + group_size, last))
+            for start in range(first, last, group_size)
+        ]
+
+        apply_rows = partial(self._cwt_group, x_arr_ft, complex_image,
+                             decimate, first)
+
+        if self._executor:
+            # Группы не пересекаются, каждая пишет в свои строки
+            list(self._executor.map(apply_rows, groups))
+
+        else:
+            for rows in groups:
+                apply_rows(rows)
 
-        self.wft = morlet_ft_box(self.scales, self.angular_frequencies,
-                                 omega0, samplerate)
+        return complex_image
+
+    def spectrum(self, data):
+        """
+        Spectrum of data without mean for bins 0..nsamples/2
 
-    def cwt(self, data, decimate=None):
+        Morlet filters are zero at other bins, so real sound needs only
+        half as long real input FFT. It depends on nsamples and precision
+        only, so boxes with other scales can reuse it.
+        """
+        if np.iscomplexobj(data):
+            x_arr = np.array(data, dtype=self.complex_dtype)
+            transform = scipy.fft.fft
 
-        x_arr = np.asarray(data, dtype=np.complex64) - np.mean(data)
-        x_width = x_arr.shape[0]
+        else:
+            x_arr = np.array(data, dtype=self.real_dtype)
+            transform = scipy.fft.rfft
 
-        if x_arr.ndim is not 1:
+        if x_arr.ndim != 1:
             raise ValueError('data must be an 1d numpy array or list')
 
         assert x_arr.shape[0] == self.nsamples
 
-        if decimate:
-            result_width = len(list(range(self.nsamples))[::decimate])
+        x_arr -= x_arr.mean()
+
+        return transform(x_arr, overwrite_x=True)[:self.nsamples // 2 + 1]
+
+    def _cwt_group(self, x_arr_ft, complex_image, decimate, first, rows):
+        out = complex_image[rows.start - first:rows.stop - first]
+        self._cwt_rows(x_arr_ft, out, decimate, rows)
+
+    def _cwt_rows(self, x_arr_ft, out, decimate, rows):
+        """ Image of scales rows into out """
+
+        # Весь блок масштабов за одно обратное FFT.
+        # Умножение и FFT отпускают GIL, поэтому потоки работают параллельно
+        bands = self.wft.bands(rows)
+        med = np.zeros((len(bands), x_arr_ft.shape[0]),
+                       dtype=self.complex_dtype)
+        multiply_bands(med, bands, x_arr_ft)
+
+        if self.nsamples % decimate == 0:
+            out[...] = ifft_decimated(med, decimate, self.nsamples)
 
         else:
-            result_width = self.nsamples
+            med = scipy.fft.ifft(med, self.nsamples, axis=1, workers=1)
+            out[...] = med[:, ::decimate]
 
-        complex_image = np.empty((self.scales.shape[0], result_width),
-                                 dtype=np.complex64)
 
-        gpu_x_arr_ft = gpuarray.to_gpu(x_arr)
-        self.plan.execute(gpu_x_arr_ft)
+def test_cwt_of_real_and_complex_data():
+    data = np.random.RandomState(0).randn(2 ** 10)
+    box = WaveletBox(2 ** 10, 8000, 1/8, 70, cache_filters=False)
 
-        gpu_med = gpuarray.empty_like(gpu_x_arr_ft)
+    for decimate in [1, 4]:
+        expected = box.cwt(data.astype(np.complex64), decimate)
+        error = np.abs(box.cwt(data, decimate) - expected).max()
 
-        for i in range(complex_image.shape[0]):
-            multiply_them(gpu_med, gpu_x_arr_ft, self.wft[i])
+        assert error < 1e-6 * np.abs(expected).max()
 
-            self.plan.execute(gpu_med, inverse=True)
 
-            if decimate:
-                reshaped = gpu_med.reshape((result_width,
-                                            x_width / result_width))
+def test_double_precision_cwt():
+    data = np.random.RandomState(0).randn(2 ** 10)
 
-                gpu_decimated = extract_columns(reshaped, 0, 1).ravel()
+    single = WaveletBox(2 ** 10, 8000, 1/8, 70, cache_filters=False)
+    double = WaveletBox(2 ** 10, 8000, 1/8, 70, cache_filters=False,
+                        precision='double')
 
-                complex_image[i] = gpu_decimated.get()
+    expected = double.cwt(data, 4)
+    assert expected.dtype == np.complex128
+    assert single.cwt(data, 4).dtype == np.complex64
 
-            else:
-                complex_image[i] = gpu_med.get()
+    error = np.abs(single.cwt(data, 4) - expected).max()
+    assert error < 1e-5 * np.abs(expected).max()
 
-        return complex_image
+
+def test_spectrum_shared_by_boxes():
+    data = np.random.RandomState(0).randn(2 ** 10)
+
+    coarse = WaveletBox(2 ** 10, 8000, 1/4, 70, cache_filters=False)
+    fine = WaveletBox(2 ** 10, 8000, 1/8, 70, cache_filters=False)
+
+    assert np.array_equal(fine.cwt_spectrum(coarse.spectrum(data), 4),
+                          fine.cwt(data, 4))
+
+
+def test_cwt_of_rows():
+    data = np.random.RandomState(0).randn(2 ** 10)
+    box = WaveletBox(2 ** 10, 8000, 1/8, 70, threads=2, cache_filters=False)
+
+    try:
+        expected = box.cwt(data, 4)
+
+        assert np.array_equal(box.cwt(data, 4, slice(3, 7)), expected[3:7])
+        assert box.cwt(data, 4, slice(5, 5)).shape == (0, 256)
+
+    finally:
+        box.close()
+
+
+def test_apply_cwt_of_empty_sound():
+    box = WaveletBox(2 ** 10, 8000, 1/8, 70, cache_filters=False)
+
+    for output in ['complex', 'magnitude']:
+        image = box._apply_cwt(iter([]), None, 4, 0, output=output)
+
+        assert image.shape == (len(box.scales), 0)
+
+
+def test_region_of_no_scales_reads_nothing():
+    class Sound(object):
+        size = 2 ** 12
+
+        def get_blocks(self, *args, **kwargs):
+            raise AssertionError('blocks are read')
+
+    box = WaveletBox(2 ** 10, 8000, 1/8, 70, cache_filters=False)
+    image = box.sound_apply_region_cwt(Sound(), None, 100, 900,
+                                       rows=slice(3, 3), decimate=4)
+
+    assert image.shape == (0, 200)
+
+
+def test_ifft_decimated():
+    spectrum = np.fft.fft(np.random.RandomState(0).randn(3, 64), axis=1)
+    spectrum[:, 33:] = 0
+
+    for decimate in [1, 8, 64]:
+        expected = np.fft.ifft(spectrum, axis=1)[:, ::decimate]
+
+        assert np.allclose(ifft_decimated(spectrum.copy(), decimate),
+                           expected)
+        assert np.allclose(ifft_decimated(spectrum[:, :33], decimate, 64),
+                           expected)
+
+
+def ifft_decimated(spectrum, decimate, nsamples=None):
+    """
+    Every decimate-th sample of the inverse FFT along axis 1
+
+    Samples n * decimate only see the spectrum folded (aliased) into
+    nsamples / decimate bins, so a decimate times shorter FFT is enough.
+    Spectrum shorter than nsamples is padded with zeros. It may be
+    overwritten.
+    """
+    rows, bins = spectrum.shape
+    nsamples = nsamples or bins
+
+    if decimate == 1:
+        return scipy.fft.ifft(spectrum, nsamples, axis=1, overwrite_x=True,
+                              workers=1)
+
+    size = nsamples // decimate
+    bulk = bins // size * size
+
+    folded = spectrum[:, :bulk].reshape(rows, -1, size).sum(axis=1)
+    folded[:, :bins - bulk] += spectrum[:, bulk:]
+
+    folded = scipy.fft.ifft(folded, axis=1, overwrite_x=True, workers=1)
+    folded /= decimate
+
+    return folded
+
+
+def test_scales_group_size():
+    assert scales_group_size(2 ** 10, 2 ** 10 * 16 * 8) == 8
+    assert scales_group_size(2 ** 10, 1) == 1
+
+
+def scales_group_size(nsamples, memory_limit, dtype=np.complex64):
+    """ How many scales fit into memory_limit at once """
+
+    # Произведение и результат обратного FFT
+    row_bytes = 2 * nsamples * np.dtype(dtype).itemsize
+
+    return max(1, memory_limit // row_bytes)
+
+
+def test_cwt_independent_of_group_size():
+    data = np.sin(np.arange(2 ** 10) / 3)
+
+    small = WaveletBox(2 ** 10, 8000, 1/8, 70, memory_limit=1,
+                       cache_filters=False)
+    large = WaveletBox(2 ** 10, 8000, 1/8, 70, cache_filters=False)
+
+    assert small.group_size == 1
+    assert large.group_size >= len(large.scales)
+    assert np.array_equal(small.cwt(data, 4), large.cwt(data, 4))
+
+
+def test_threaded_cwt_matches_serial():
+    data = np.sin(np.arange(2 ** 10) / 3)
+
+    serial = WaveletBox(2 ** 10, 8000, 1/8, 70, cache_filters=False)
+    threaded = WaveletBox(2 ** 10, 8000, 1/8, 70, threads=4,
+                          cache_filters=False)
+
+    try:
+        assert threaded.group_size < len(threaded.scales)
+        assert np.array_equal(serial.cwt(data, 4), threaded.cwt(data, 4))
+
+    finally:
+        threaded.close()
 
 
 def normalization(scale, samplerate):
     return np.sqrt(PI2 * scale * samplerate)
 
 
-def morlet_ft_box(scales, angular_frequencies, omega0, samplerate):
-    """ Fourier tranformed morlet function """
+def morlet_ft(scale, angular_frequencies, omega0, samplerate):
+    """ Fourier tranformed morlet function at positive frequencies """
 
     pi_sqr_1_4 = 0.75112554446494251  # pi**(-1.0/4.0)
 
-    wavelet = [None] * scales.shape[0]
+    norma = normalization(scale, samplerate)
 
-    gpu_angular_frequencies = gpuarray.to_gpu(angular_frequencies)
+    return norma * pi_sqr_1_4 * np.exp(
+        -(scale * angular_frequencies - omega0) ** 2 / 2
+    )
 
-    for i in range(scales.shape[0]):
-        norma = normalization(scales[i], samplerate)
 
-        wavelet[i] = gpuarray.empty(
-            (angular_frequencies.shape[0],),
-            dtype=np.complex64
-        )
+def gaussian_half_band(epsilon):
+    """ exp(-x ** 2 / 2) < epsilon for |x| above this """
 
-        calculate_morlet(
-            wavelet[i],
-            norma * pi_sqr_1_4,
-            scales[i],
-            gpu_angular_frequencies,
-            omega0
-        )
+    return np.sqrt(2 * np.log(1 / epsilon))
+
+
+def morlet_ft_packed(scales, angular_frequencies, omega0, samplerate,
+                     epsilon=0, dtype=np.float32):
+    """
+    Fourier tranformed morlet function for bins 0..nsamples/2
+
+    It is real and zero at other bins, so only that half is considered.
+    Each filter is a narrow gaussian, only its band above epsilon times
+    the peak (or above zero) is kept.
+    """
+
+    bins = angular_frequencies.shape[0] // 2 + 1
+    bin_width = angular_frequencies[1]
+
+    starts = np.empty(scales.shape[0], dtype=np.int64)
+    stops = np.empty(scales.shape[0], dtype=np.int64)
+    values = []
+
+    for i, scale in enumerate(scales):
+        if epsilon:
+            half_band = gaussian_half_band(epsilon)
+            lower = (omega0 - half_band) / scale / bin_width
+            upper = (omega0 + half_band) / scale / bin_width
+
+            start = max(1, int(np.ceil(lower)))
+            stop = max(start, min(bins, int(np.floor(upper)) + 1))
+
+        else:
+            wavelet = morlet_ft(scale, angular_frequencies[1:bins],
+                                omega0, samplerate).astype(dtype)
+
+            nonzero = np.flatnonzero(wavelet)
+
+            if len(nonzero):
+                # Нулевую частоту пропустили
+                start, stop = nonzero[0] + 1, nonzero[-1] + 2
+
+            else:
+                start = stop = 1
+
+        starts[i], stops[i] = start, stop
+        values.append(morlet_ft(scale, angular_frequencies[start:stop],
+                                omega0, samplerate).astype(dtype))
+
+    return PackedFilters(starts, stops, np.concatenate(values))
+
+
+class PackedFilters(object):
+    """
+    Filters as (start bin, stop bin, values) in one contiguous buffer
+
+    Filter i is values[offsets[i]:offsets[i + 1]] at bins starts[i]..stops[i]
+    and zero elsewhere.
+    """
+
+    def __init__(self, starts, stops, values):
+        self.starts = starts
+        self.stops = stops
+        self.values = values
+
+        self.offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+        np.cumsum(stops - starts, out=self.offsets[1:])
+
+    def __len__(self):
+        return self.starts.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.starts.nbytes + self.stops.nbytes + self.values.nbytes
+
+    def arrays(self):
+        return {
+            'starts': self.starts,
+            'stops': self.stops,
+            'values': self.values,
+        }
+
+    def band(self, i):
+        return self.starts[i], \
+            self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def bands(self, rows):
+        """ List of (start bin, values) for slice of rows """
 
-    return wavelet
+        return [self.band(i) for i in range(*rows.indices(len(self)))]
 
 
-def extract_columns(mat, start, stop):
-    stop = stop or start + 1
-    dtype = mat.dtype
-    itemsize = np.dtype(dtype).itemsize
-    N, M = mat.shape
-    m = stop - start
+def test_multiply_bands():
+    packed = PackedFilters(np.array([1, 0]), np.array([3, 1]),
+                           np.array([2, 3, 4]))
+    out = np.zeros((2, 4))
 
-    assert mat.flags.c_contiguous
-    assert 0 <= start < stop <= M
+    multiply_bands(out, packed.bands(slice(None)), np.arange(4))
 
-    new_mat = gpuarray.empty((N, m), dtype)
+    assert out.tolist() == [[0, 2, 6, 0], [0, 0, 0, 0]]
 
-    copy = cuda.Memcpy2D()
-    copy.set_src_device(mat.gpudata)
-    copy.src_x_in_bytes = start * itemsize  # First column offset in bytes
-    copy.set_dst_device(new_mat.gpudata)
 
-    copy.src_pitch = int(M) * itemsize  # Source array row width in bytes
-    copy.dst_pitch = copy.width_in_bytes = m * itemsize  # Width of sliced row
-    copy.height = N
-    copy(aligned=True)
+def multiply_bands(out, bands, spectrum):
+    """ Dense products of packed filters and spectrum into out rows """
 
-    return new_mat
+    for row, (start, values) in zip(out, bands):
+        stop = start + values.shape[0]
+        np.multiply(values, spectrum[start:stop], out=row[start:stop])
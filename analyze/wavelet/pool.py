@@ -0,0 +1,170 @@
+"""
+Process wide pool of wavelet boxes reused by compositions
+
+Boxes are shared by their parameters and counted by references. Unused
+boxes stop their workers (process backend) and keep only filters, they
+stay in the pool until their memory is needed or there are more than
+max_idle of them, least recently used go first.
+"""
+
+from collections import OrderedDict
+import logging
+import threading
+
+from .registry import create_wavelet_box
+
+
+log = logging.getLogger(__name__)
+
+
+MAX_IDLE_BOXES = 4
+
+
+class WaveletBoxPool(object):
+    def __init__(self, memory_limit, max_idle=MAX_IDLE_BOXES):
+        self.memory_limit = memory_limit
+        self.max_idle = max_idle
+        self._boxes = OrderedDict()  # key -> [box, references]
+        self._lock = threading.Lock()
+
+    def acquire(self, backend, nsamples, samplerate, scale_resolution,
+                omega0, workers=None, decimate=None, **options):
+        # decimate только помогает выбрать backend для 'auto'
+        key = (backend, nsamples, float(samplerate),
+               float(scale_resolution), float(omega0), workers,
+               decimate if backend == 'auto' else None,
+               tuple(sorted(options.items())))
+
+        with self._lock:
+            if key in self._boxes:
+                return self._take(key)
+
+        log.debug('Create wavelet box %r', key)
+
+        # Долго, поэтому без блокировки
+        box = create_wavelet_box(backend, nsamples, samplerate,
+                                 scale_resolution, omega0, workers, decimate,
+                                 **options)
+
+        with self._lock:
+            if key in self._boxes:
+                # Другой поток успел создать такую же
+                box.close()
+
+            else:
+                self._boxes[key] = [box, 0]
+
+            box = self._take(key)
+            self._evict()
+
+        return box
+
+    def release(self, box):
+        with self._lock:
+            for entry in self._boxes.values():
+                if entry[0] is box:
+                    entry[1] -= 1
+
+                    if not entry[1]:
+                        box.stop_workers()
+
+                    break
+
+            else:
+                box.close()
+
+            self._evict()
+
+    def clear(self):
+        """ Close all boxes which are not in use """
+
+        with self._lock:
+            self._evict(memory_limit=0, max_idle=0)
+
+    @property
+    def nbytes(self):
+        return sum(box.nbytes for box, _ in self._boxes.values())
+
+    def _take(self, key):
+        self._boxes.move_to_end(key)
+        entry = self._boxes[key]
+        entry[1] += 1
+
+        return entry[0]
+
+    def _evict(self, memory_limit=None, max_idle=None):
+        if memory_limit is None:
+            memory_limit = self.memory_limit
+
+        if max_idle is None:
+            max_idle = self.max_idle
+
+        total = self.nbytes
+        idle = sum(1 for _, references in self._boxes.values()
+                   if not references)
+
+        for key, (box, references) in list(self._boxes.items()):
+            if references:
+                continue
+
+            if total <= memory_limit and idle <= max_idle:
+                break
+
+            log.debug('Free wavelet box %r', key)
+
+            del self._boxes[key]
+            box.close()
+            total -= box.nbytes
+            idle -= 1
+
+
+def test_pool_reuses_and_evicts_boxes():
+    pool = WaveletBoxPool(memory_limit=0)
+    params = ('numpy', 2 ** 10, 8000, 1/8, 70)
+
+    box = pool.acquire(*params, cache_filters=False)
+    assert pool.acquire(*params, cache_filters=False) is box
+
+    pool.release(box)
+    assert pool.acquire(*params, cache_filters=False) is box
+
+    pool.release(box)
+    pool.release(box)
+    assert pool.acquire(*params, cache_filters=False) is not box
+
+
+def test_pool_limits_idle_boxes():
+    pool = WaveletBoxPool(memory_limit=2 ** 30, max_idle=1)
+    params = ('numpy', 2 ** 10, 8000)
+
+    first = pool.acquire(*params, 1/8, 70, cache_filters=False)
+    second = pool.acquire(*params, 1/4, 70, cache_filters=False)
+
+    pool.release(first)
+    pool.release(second)
+    third = pool.acquire(*params, 1/8, 70, cache_filters=False)
+    assert third is not first
+
+    pool.release(third)
+    pool.clear()
+    assert not pool._boxes
+
+
+def test_pool_stops_workers_of_idle_boxes():
+    pool = WaveletBoxPool(memory_limit=2 ** 30)
+    params = ('process', 2 ** 10, 8000, 1/8, 70, 1)
+
+    box = pool.acquire(*params, decimate=4)
+    assert pool.acquire(*params, decimate=8) is box
+
+    box.executor
+    pool.release(box)
+    assert box._executor is not None
+
+    pool.release(box)
+    assert box._executor is None
+
+    pool.clear()
+
+
+WAVELET_BOXES = WaveletBoxPool(memory_limit=2 ** 30)
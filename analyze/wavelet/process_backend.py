@@ -0,0 +1,166 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import logging
+import os
+
+import numpy as np
+
+from .base import BaseWaveletBox
+from .intel_backend import DEFAULT_MEMORY_LIMIT, \
+    WaveletBox as NumpyWaveletBox
+
+
+log = logging.getLogger(__name__)
+
+
+class WaveletBox(BaseWaveletBox):
+    """
+    Overlapped blocks are transformed in parallel by a pool of processes
+
+    Every worker builds its own numpy WaveletBox once and writes block
+    images into shared memory, so no image is pickled.
+    """
+
+    def __init__(self, nsamples, samplerate, scale_resolution, omega0,
+                 memory_limit=DEFAULT_MEMORY_LIMIT, processes=None,
+                 precision='single'):
+        super(WaveletBox, self). \
+            __init__(nsamples, samplerate, scale_resolution, omega0,
+                     precision)
+
+        self.processes = processes or os.cpu_count()
+
+        self._worker_box_kwargs = dict(
+            nsamples=nsamples,
+            samplerate=samplerate,
+            scale_resolution=scale_resolution,
+            omega0=omega0,
+            memory_limit=memory_limit // self.processes,
+            precision=precision,
+        )
+
+        self._executor = None
+
+    @property
+    def executor(self):
+        if not self._executor:
+            self._executor = ProcessPoolExecutor(
+                self.processes,
+                initializer=_init_worker,
+                initargs=(self._worker_box_kwargs,)
+            )
+
+        return self._executor
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+
+    def stop_workers(self):
+        # Пул процессов создается заново при следующем cwt
+        self.close()
+
+    def cwt(self, data, decimate=None, rows=None):
+        return self.executor.submit(_worker_cwt, data, decimate,
+                                    rows=rows).result()
+
+    def _iter_block_images(self, pieces, decimate, transformed=False,
+                           **kwargs):
+        """
+        Workers write images into a ring of shared memory slots, each is
+        copied out in turn, so no image is pickled
+
+        Spectrum of this box is the piece itself, so transformed pieces
+        are transformed as usual.
+        """
+        first, last, _ = (kwargs.get('rows') or slice(None)).indices(
+            len(self.scales)
+        )
+        shape = (2 * self.processes + 1, max(0, last - first),
+                 len(range(0, self.nsamples, decimate or 1)))
+
+        with SharedArray(shape, self.complex_dtype) as slots:
+            pending = deque()
+
+            for index, piece in enumerate(pieces):
+                slot = index % shape[0]
+                pending.append((slot, self.executor.submit(
+                    _worker_cwt_to_slot, slots.spec, slot, piece, decimate,
+                    **kwargs
+                )))
+
+                # Слот следующего куска освобождается, когда скопирован
+                if len(pending) == shape[0]:
+                    yield take_slot(slots, *pending.popleft())
+
+            while pending:
+                yield take_slot(slots, *pending.popleft())
+
+
+def take_slot(slots, slot, future):
+    future.result()
+
+    return np.array(slots.array[slot])
+
+
+class SharedArray(object):
+    """ Numpy array in a multiprocessing shared memory segment """
+
+    def __init__(self, shape, dtype):
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.shm = None
+
+    @property
+    def spec(self):
+        return self.shm.name, self.shape, self.dtype.str
+
+    def __enter__(self):
+        size = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.shm = SharedMemory(create=True, size=max(1, size))
+        self.array = np.ndarray(self.shape, self.dtype, buffer=self.shm.buf)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        del self.array
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+
+_worker_box = None
+_worker_shared = {}
+
+
+def _init_worker(box_kwargs):
+    global _worker_box
+
+    _worker_box = NumpyWaveletBox(**box_kwargs)
+
+
+def _worker_cwt(data, decimate, **kwargs):
+    return _worker_box.cwt(data, decimate, **kwargs)
+
+
+def _attach_shared(spec):
+    name, shape, dtype = spec
+
+    if name not in _worker_shared:
+        # Сегмент от предыдущего вызова больше не нужен
+        for old_name in list(_worker_shared):
+            shm, array = _worker_shared.pop(old_name)
+            del array
+            shm.close()
+
+        shm = SharedMemory(name)
+        array = np.ndarray(shape, dtype, buffer=shm.buf)
+        _worker_shared[name] = (shm, array)
+
+    return _worker_shared[name][1]
+
+
+def _worker_cwt_to_slot(spec, slot, data, decimate, **kwargs):
+    _attach_shared(spec)[slot] = _worker_box.cwt(data, decimate, **kwargs)
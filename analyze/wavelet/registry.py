@@ -0,0 +1,217 @@
+"""
+Wavelet box backends by name and measured choice of the fastest one
+"""
+
+from collections import OrderedDict
+import importlib
+import json
+import logging
+import os
+import platform
+import tempfile
+import time
+
+import numpy as np
+
+from ..cache import CACHE_DIR
+from utils import IterableWithLength, ProgressProxy
+
+
+log = logging.getLogger(__name__)
+
+
+CALIBRATION_FILE = os.path.join(CACHE_DIR, 'backends.json')
+
+# Сколько блоков nsamples длины считать при калибровке
+CALIBRATION_BLOCKS = 2
+
+
+BACKENDS = OrderedDict()
+
+
+def register_backend(name, module, workers_argument=None,
+                     approximate=False, **box_kwargs):
+    """
+    Make WaveletBox from module available by name
+
+    workers_argument names the box argument which receives workers count.
+    Approximate backends are never chosen by 'auto'.
+    """
+    BACKENDS[name] = (module, workers_argument, approximate, box_kwargs)
+
+
+register_backend('numpy', '.intel_backend', threads=1)
+register_backend('threaded', '.intel_backend', workers_argument='threads')
+register_backend('process', '.process_backend',
+                 workers_argument='processes')
+register_backend('cuda', '.cuda_backend')
+register_backend('band', '.band_backend', workers_argument='threads',
+                 approximate=True)
+
+
+def load_backend(name):
+    if name not in BACKENDS:
+        raise ValueError('Unknown backend {!r}, choose one of {}'.format(
+            name, ', '.join(['auto'] + list(BACKENDS))
+        ))
+
+    module_name, workers_argument, _, box_kwargs = BACKENDS[name]
+    module = importlib.import_module(module_name, __package__)
+
+    return module.WaveletBox, workers_argument, box_kwargs
+
+
+def test_available_backends():
+    assert 'numpy' in available_backends()
+
+
+def available_backends(exact=False):
+    names = []
+
+    for name, (_, _, approximate, _) in BACKENDS.items():
+        if exact and approximate:
+            continue
+
+        try:
+            load_backend(name)
+
+        except Exception as e:
+            # Например pycuda без видеокарты
+            log.debug('Backend %s is not available: %r', name, e)
+
+        else:
+            names.append(name)
+
+    return names
+
+
+def create_wavelet_box(backend, nsamples, samplerate, scale_resolution,
+                       omega0, workers=None, decimate=None, **options):
+    """ options are passed to the box, like epsilon of 'band' """
+
+    if backend == 'auto':
+        backend = select_backend(nsamples, samplerate, scale_resolution,
+                                 omega0, workers, decimate, **options)
+
+    box_class, workers_argument, box_kwargs = load_backend(backend)
+
+    box_kwargs = dict(box_kwargs, **options)
+
+    if workers_argument:
+        box_kwargs[workers_argument] = workers
+
+    return box_class(nsamples, samplerate, scale_resolution, omega0,
+                     **box_kwargs)
+
+
+def select_backend(*params, **options):
+    """
+    Fastest backend for params and box options (like precision),
+    measured once per machine
+    """
+    key = calibration_key(*params, **options)
+    calibrated = load_calibration()
+
+    if calibrated.get(key) in BACKENDS:
+        return calibrated[key]
+
+    timings = calibrate(available_backends(exact=True), *params, **options)
+
+    if not timings:
+        raise ValueError('No backend accepts options {!r}'.format(options))
+
+    fastest = min(timings, key=timings.get)
+
+    log.info('Calibrated backends %r, choose %s', timings, fastest)
+
+    calibrated[key] = fastest
+    save_calibration(calibrated)
+
+    return fastest
+
+
+def calibrate(names, nsamples, samplerate, scale_resolution, omega0,
+              workers, decimate, **options):
+    """ Seconds per backend, backends rejecting options are left out """
+
+    sound = CalibrationSound(CALIBRATION_BLOCKS * nsamples, samplerate)
+
+    timings = {}
+
+    for name in names:
+        try:
+            box = create_wavelet_box(name, nsamples, samplerate,
+                                     scale_resolution, omega0, workers,
+                                     **options)
+
+        except (TypeError, ValueError) as e:
+            # Например cuda только с одинарной точностью
+            log.debug('Backend %s rejects %r: %r', name, options, e)
+            continue
+
+        try:
+            start = time.perf_counter()
+            box.sound_apply_cwt(sound, ProgressProxy, decimate=decimate)
+            timings[name] = time.perf_counter() - start
+
+        finally:
+            box.close()
+
+    return timings
+
+
+def test_calibration_key_depends_on_precision():
+    params = (2 ** 10, 8000, 1/8, 70, None, 4)
+
+    assert calibration_key(*params) == \
+        calibration_key(*params, precision='single')
+    assert calibration_key(*params) != \
+        calibration_key(*params, precision='double')
+
+
+def calibration_key(nsamples, samplerate, scale_resolution, omega0,
+                    workers, decimate, precision='single', **options):
+    machine = '{}/{}'.format(platform.node(), os.cpu_count())
+    params = (nsamples, samplerate, scale_resolution, omega0, workers,
+              decimate, precision) + tuple(sorted(options.items()))
+
+    return '{} {!r}'.format(machine, params)
+
+
+def load_calibration():
+    try:
+        with open(CALIBRATION_FILE) as f:
+            return json.load(f)
+
+    except (OSError, ValueError):
+        return {}
+
+
+def save_calibration(calibrated):
+    directory = os.path.dirname(CALIBRATION_FILE)
+    os.makedirs(directory, exist_ok=True)
+
+    # Атомарно, чтобы параллельные процессы не прочитали половину файла
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+
+    with os.fdopen(fd, 'w') as f:
+        json.dump(calibrated, f, indent=1, sort_keys=True)
+
+    os.replace(tmp_path, CALIBRATION_FILE)
+
+
+class CalibrationSound(object):
+    """ Synthetic noise with the Sound blocks interface """
+
+    def __init__(self, size, samplerate):
+        self.size = size
+        self.samplerate = samplerate
+        self.samples = np.random.RandomState(0).uniform(-1, 1, size)
+
+    def get_blocks(self, block_size):
+        blocks = [
+            self.samples[i:i + block_size]
+            for i in range(0, self.size, block_size)
+        ]
+
+        return IterableWithLength(blocks, len(blocks))
@@ -2,10 +2,32 @@
 Unspecific gui classes
 """
 
+import numpy as np
 from PyQt5.QtCore import pyqtSignal, Qt, QPoint, QPointF, QRect, QRectF
+from PyQt5.QtGui import QImage
 from PyQt5.QtWidgets import QGraphicsView, QRubberBand
 
 
+def rgb_to_qimage(rgb):
+    """
+    QImage over memory of RGB uint8 array (height, width, 3) without copy
+
+    The array is kept alive by the returned image. Qt side copies of
+    the image share the memory too, so convert them (QPixmap.fromImage)
+    or copy() before the image is dropped.
+    """
+    rgb = np.require(rgb, np.uint8, 'C')
+    height, width = rgb.shape[:2]
+
+    image = QImage(rgb.data, width, height, rgb.strides[0],
+                   QImage.Format_RGB888)
+
+    # QImage не владеет буфером
+    image.array = rgb
+
+    return image
+
+
 class RubberbandSelectionQGraphicsView(QGraphicsView):
     def __init__(self, scene):
         super().__init__(self.scene)
@@ -58,6 +58,7 @@ class QCompositionWorker(QThreadedWorker):
         self.process.connect(self._process)
 
     process = pyqtSignal(Sound, QProgressDialog)
+    process_pass = pyqtSignal(Spectrogram)
     process_ok = pyqtSignal(Spectrogram)
     process_error = pyqtSignal(str)
 
@@ -86,11 +87,17 @@ class QCompositionWorker(QThreadedWorker):
 
         try:
             with Composition(
-                sound_resampled, scale_resolution=1/155, omega0=70
+                sound_resampled, scale_resolution=1/155, omega0=70,
+                cache=True, resumable=True
             ) as composition:
 
                 self._message('Analyse')
-                spectrogram = composition.get_spectrogram(progressbar)
+
+                # Грубые проходы показываются сразу, каждый следующий
+                # приходит новым изображением
+                for spectrogram in \
+                        composition.iter_progressive_spectrograms(progressbar):
+                    self.process_pass.emit(spectrogram)
 
         except CompositionCanceled:
             log.debug('Composition canceled')
@@ -0,0 +1,25 @@
+import logging
+
+from PyQt5.QtCore import pyqtSignal
+
+from .threading import QThreadedWorkerDebug as QThreadedWorker
+from analyze.media.pyramid import TilePyramid
+
+
+log = logging.getLogger(__name__)
+
+
+class QPyramidWorker(QThreadedWorker):
+    """ Builds levels of tile pyramids in the background """
+
+    def __init__(self):
+        super().__init__()
+        self.process.connect(self._process)
+
+    process = pyqtSignal(TilePyramid)
+    level_ready = pyqtSignal(TilePyramid, int)
+
+    def _process(self, pyramid):
+        for level in pyramid.build():
+            log.debug('Pyramid level %d of %r built', level, pyramid)
+            self.level_ready.emit(pyramid, level)
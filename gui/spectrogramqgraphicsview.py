@@ -2,10 +2,13 @@ import logging
 
 import numpy as np
 from PyQt5.QtCore import pyqtSignal, Qt, QPointF, QRectF
-from PyQt5.QtGui import QPainter, QPixmap, QImage, QBrush, QColor, QPen
-from PyQt5.QtWidgets import QGraphicsScene
+from PyQt5.QtGui import QPainter, QBrush, QColor, QPen
+from PyQt5.QtWidgets import QGraphicsItem, QGraphicsScene, \
+    QGraphicsView, QStyleOptionGraphicsItem
 
-from . import RubberbandSelectionQGraphicsView
+from . import RubberbandSelectionQGraphicsView, rgb_to_qimage
+from .pyramid_worker import QPyramidWorker
+from analyze.media.pyramid import TilePyramid
 from analyze.media.notes import HARMONIC_COLORS, INTERVALS, NOTES_COLORS
 from analyze.media.sound import SoundFragment
 from utils import is_int_power_of_two
@@ -14,17 +17,88 @@ from utils import is_int_power_of_two
 log = logging.getLogger(__name__)
 
 
+# Во сколько раз меняется масштаб за щелчок колеса мыши
+ZOOM_STEP = 1.25
+
+
+class SpectrogramTilesItem(QGraphicsItem):
+    """
+    Spectrogram painted from the tile pyramid
+
+    Item coordinates are pixels of the full image. Only tiles under the
+    exposed rect are painted, from the level matching the current zoom.
+    """
+
+    def __init__(self, pyramid):
+        super().__init__()
+        self.pyramid = pyramid
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def boundingRect(self):
+        return QRectF(0, 0, self.pyramid.width, self.pyramid.height)
+
+    def paint(self, painter, option, widget=None):
+        scale = QStyleOptionGraphicsItem.levelOfDetailFromTransform(
+            painter.worldTransform()
+        )
+        level = self.pyramid.level_for_scale(scale)
+
+        factor = 2 ** level
+        size = self.pyramid.tile_size * factor
+        rows, columns = self.pyramid.tiles_count(level)
+
+        rect = option.exposedRect.intersected(self.boundingRect())
+
+        first_row, last_row = tiles_range(rect.top(), rect.bottom(),
+                                          size, rows)
+        first_column, last_column = tiles_range(rect.left(), rect.right(),
+                                                size, columns)
+
+        # Последний тайл грубого уровня может выйти за край
+        painter.setClipRect(self.boundingRect())
+
+        for row in range(first_row, last_row):
+            for column in range(first_column, last_column):
+                tile = self.pyramid.tile(level, row, column)
+                height, width = tile.shape[:2]
+
+                # Тайл лежит в кеше пирамиды, рисуется прямо из него
+                image = rgb_to_qimage(tile)
+
+                painter.drawImage(
+                    QRectF(column * size, row * size,
+                           width * factor, height * factor),
+                    image
+                )
+
+
+def tiles_range(begin, end, size, count):
+    return max(0, int(begin // size)), min(count, int(end // size) + 1)
+
+
 class SpectrogramQGraphicsScene(QGraphicsScene):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.setItemIndexMethod(QGraphicsScene.NoIndex)
         self.selection_rect_item = None
         self.harmonics_items = []
+        self.tiles_item = None
 
     def clear(self):
+        if self.tiles_item:
+            self.tiles_item.pyramid.cancel()
+
         super().clear()
         self.selection_rect_item = None
         self.harmonics_items = []
+        self.tiles_item = None
+
+    def set_pyramid(self, pyramid):
+        self.clear()
+
+        self.tiles_item = SpectrogramTilesItem(pyramid)
+        self.addItem(self.tiles_item)
+        self.setSceneRect(self.tiles_item.boundingRect())
 
     def set_selection(self, rect):
         if self.selection_rect_item:
@@ -55,6 +129,10 @@ class SpectrogramQGraphicsView(RubberbandSelectionQGraphicsView):
         super().__init__(self.scene)
 
         self.setRenderHint(QPainter.Antialiasing)
+        self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
+
+        self.pyramid_worker = QPyramidWorker()
+        self.pyramid_worker.level_ready.connect(self.on_pyramid_level_ready)
 
         # self.setCacheMode(QGraphicsView.CacheBackground)
         # self.setViewportUpdateMode(QGraphicsView.BoundingRectViewportUpdate)
@@ -67,27 +145,25 @@ class SpectrogramQGraphicsView(RubberbandSelectionQGraphicsView):
 
     def update_spectrogram(self, spectrogram):
         self.spectrogram = spectrogram
-        self.show_image(spectrogram.image)
-
-    def reset(self):
-        self.spectrogram = None
-        self.scene.clear()
+        self.show_pyramid(TilePyramid(spectrogram.abs_image))
 
-        self.reseted.emit()
+    def show_pyramid(self, pyramid):
+        """ Show level 0 at once, coarser levels appear when built """
 
-    def show_image(self, im):
-        if im.mode != 'RGB':
-            im = im.convert('RGB')
+        self.scene.set_pyramid(pyramid)
+        self.pyramid_worker.process.emit(pyramid)
 
-        # buf_data = im.tostring('raw', 'BGRX')
-        # image = QImage(buf_data, im.size[0], im.size[1],
-        #                QImage.Format_RGB32)
+    def on_pyramid_level_ready(self, pyramid, level):
+        tiles_item = self.scene.tiles_item
 
-        im.save('/tmp/spectrogram.png')
-        image = QImage('/tmp/spectrogram.png')
+        if tiles_item and tiles_item.pyramid is pyramid:
+            tiles_item.update()
 
+    def reset(self):
+        self.spectrogram = None
         self.scene.clear()
-        self.scene.addPixmap(QPixmap.fromImage(image))
+
+        self.reseted.emit()
 
     def on_rect_selected(self, rect):
         if not self.spectrogram:
@@ -187,12 +263,7 @@ class SpectrogramQGraphicsView(RubberbandSelectionQGraphicsView):
         if event.buttons() == Qt.RightButton:
             self.deal_with_harmonics(event.pos())
 
-
-# void MyGraphics::wheelEvent(QWheelEvent *event){
-#     if(event->delta() > 0){
-#         //Zoom in
-#         this->zoomIn();
-#     } else {
-#         this->zoomOut();
-#     }
-# }
+    def wheelEvent(self, event):
+        # Один щелчок колеса - 120
+        factor = ZOOM_STEP ** (event.angleDelta().y() / 120)
+        self.scale(factor, factor)
@@ -35,6 +35,9 @@ class MainWindow(QMainWindow):
 
         self.composition_worker = QCompositionWorker()
         self.composition_worker.message.connect(self.status_show)
+        self.composition_worker.process_pass.connect(
+            self.on_composition_pass
+        )
         self.composition_worker.process_ok.connect(
             self.on_composition_processed
         )
@@ -176,11 +179,18 @@ class MainWindow(QMainWindow):
 
         self.composition_worker.process.emit(sound, self.progress_dialog)
 
-    def on_composition_processed(self, spectrogram):
+    def on_composition_pass(self, spectrogram):
         log.debug('Run update_spectrogram %s', spectrogram)
-        self.status_show('Processed')
+        self.status_show('Refining')
         self.spectrogram_view.update_spectrogram(spectrogram)
 
+    def on_composition_processed(self, spectrogram):
+        self.status_show('Processed')
+
+        # Последний проход уже показан
+        if self.spectrogram_view.spectrogram is not spectrogram:
+            self.spectrogram_view.update_spectrogram(spectrogram)
+
     def on_composition_process_error(self, msg):
         self.fname = None
         self.status_show(msg)
@@ -1,4 +1,4 @@
-import collections
+import collections.abc
 import math
 
 
@@ -13,7 +13,7 @@ class cached_property(object):
         return res
 
 
-class IterableWithLength(collections.Iterator):
+class IterableWithLength(collections.abc.Iterator):
     def __init__(self, iterable, length):
         self._iterable = iter(iterable)
         self.length = length
@@ -27,7 +27,7 @@ class IterableWithLength(collections.Iterator):
         return next(self._iterable)
 
 
-class ProgressProxy(collections.Iterator):
+class ProgressProxy(collections.abc.Iterator):
     def __init__(self, iterable, length=None):
         if length is None:
             length = _length_hint(iterable)